@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+# A local stand-in for the p4 command line client, covering the commands
+# the package builders use: client -i, sync, diff -se/-sd and have. It
+# is passed to the builders with --p4, for instance
+#
+#   --p4 "python p4stub.py /tmp/depot /tmp/p4state"
+#
+# The depot is a plain directory, //depot/a/b is the file a/b in it.
+# Every file has a single revision, a file changes when its content
+# does. The client spec and the have list are kept in the state
+# directory, and every file the stand-in writes to the workspace is
+# logged to writes.log there. Commands run one at a time, the builders
+# sync several paths side by side. Like p4, sync does not overwrite
+# writable files unless the client has the clobber option, and makes
+# the files it writes read-only unless it has allwrite.
+
+import fcntl
+import hashlib
+import os
+import re
+import sys
+
+DEPOT_PREFIX = "//depot/"
+
+depotDir = None
+stateDir = None
+
+# Returns the digest of the content of a file
+def digest(fileName):
+    file = open(fileName, "rb")
+    data = file.read()
+    file.close()
+    return hashlib.sha1(data).hexdigest()
+
+
+
+# Reads the client spec stored by "client -i", returns a tuple of
+# (root, options, view) where view is a list of (depot, client)
+# prefixes
+def readClient():
+    root = None
+    options = []
+    view = []
+    for line in open(os.path.join(stateDir, "client")):
+        line = line.strip()
+        if line.startswith("Root:"):
+            root = line[5:].strip()
+        elif line.startswith("Options:"):
+            options = line[8:].split()
+        elif line.startswith("//"):
+            (depot, client) = line.split()
+            view.append((depot.replace("...", ""), client.replace("...", "")))
+    return (root, options, view)
+
+
+
+# Returns the have list, a dictionary of depot path to digest
+def readHave():
+    have = {}
+    haveFile = os.path.join(stateDir, "have")
+    if os.path.isfile(haveFile):
+        for line in open(haveFile):
+            (path, fileDigest) = line.rstrip("\n").split("\t")
+            have[path] = fileDigest
+    return have
+
+
+
+def writeHave(have):
+    file = open(os.path.join(stateDir, "have"), "w")
+    for path in sorted(have.keys()):
+        file.write("%s\t%s\n" % (path, have[path]))
+    file.close()
+
+
+
+# Returns the local file of a depot path, or None if it is not mapped
+def localFile(path, root, view):
+    for (depot, client) in view:
+        if path == depot or (depot.endswith("/") and path.startswith(depot)):
+            clientPath = client + path[len(depot):]
+            return os.path.join(root, clientPath.split("/", 3)[3])
+    return None
+
+
+
+# Returns the depot paths of all the files in the depot
+def depotFiles():
+    files = []
+    for (dir, dirs, names) in os.walk(depotDir):
+        for name in names:
+            files.append(DEPOT_PREFIX + os.path.relpath(os.path.join(dir, name), depotDir).replace(os.sep, "/"))
+    return files
+
+
+
+# Returns true if the depot path is selected by one of the file
+# arguments, which are depot paths, local files or //client/... for
+# the whole client
+def selected(path, local, args, client):
+    if not args:
+        return True
+    for arg in args:
+        arg = re.sub("[@#].*$", "", arg)
+        if arg == "//%s/..." % client:
+            return True
+        elif arg.startswith("//"):
+            if path == arg or (arg.endswith("...") and path.startswith(arg[:-3])):
+                return True
+        elif os.path.normpath(arg) == os.path.normpath(local):
+            return True
+    return False
+
+
+
+def sync(client, force, args):
+    (root, options, view) = readClient()
+    have = readHave()
+    log = open(os.path.join(stateDir, "writes.log"), "a")
+    files = depotFiles()
+    for path in sorted(set(files) | set(have.keys())):
+        local = localFile(path, root, view)
+        if local is None or not selected(path, local, args, client):
+            continue
+        if not path in files:
+            if os.path.lexists(local):
+                os.remove(local)
+            del have[path]
+            print "%s#1 - deleted as %s" % (path, local)
+            continue
+        fileDigest = digest(os.path.join(depotDir, path[len(DEPOT_PREFIX):]))
+        if have.get(path) == fileDigest and not force:
+            continue
+        if os.path.isfile(local) and os.access(local, os.W_OK) and not force and not "clobber" in options:
+            print "Can't clobber writable file %s" % local
+            continue
+        if os.path.lexists(local):
+            action = "updating"
+            os.chmod(local, 0644)
+            os.remove(local)
+        else:
+            action = "added as"
+            if not os.path.isdir(os.path.dirname(local)):
+                os.makedirs(os.path.dirname(local))
+        source = open(os.path.join(depotDir, path[len(DEPOT_PREFIX):]), "rb")
+        target = open(local, "wb")
+        target.write(source.read())
+        target.close()
+        source.close()
+        if "allwrite" in options:
+            os.chmod(local, 0644)
+        else:
+            os.chmod(local, 0444)
+        have[path] = fileDigest
+        log.write(local + "\n")
+        print "%s#1 - %s %s" % (path, action, local)
+    log.close()
+    writeHave(have)
+
+
+
+def diff(flag):
+    (root, options, view) = readClient()
+    for (path, fileDigest) in sorted(readHave().items()):
+        local = localFile(path, root, view)
+        if flag == "-sd" and not os.path.isfile(local):
+            print path
+        elif flag == "-se" and os.path.isfile(local) and digest(local) != fileDigest:
+            print path
+
+
+
+def main():
+    global depotDir
+    global stateDir
+    depotDir = sys.argv[1]
+    stateDir = sys.argv[2]
+    args = sys.argv[3:]
+
+    client = None
+    listFile = None
+    while args and args[0] in ("-u", "-c", "-x"):
+        if args[0] == "-c":
+            client = args[1]
+        elif args[0] == "-x":
+            listFile = args[1]
+        args = args[2:]
+
+    command = args[0]
+    args = args[1:]
+    if listFile:
+        args.extend([line.strip() for line in open(listFile) if line.strip()])
+
+    lock = open(os.path.join(stateDir, "lock"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+
+    if command == "client":
+        file = open(os.path.join(stateDir, "client"), "w")
+        file.write(sys.stdin.read())
+        file.close()
+    elif command == "sync":
+        force = "-f" in args
+        sync(client, force, [arg for arg in args if arg != "-f"])
+    elif command == "diff":
+        diff(args[0])
+    elif command == "have":
+        (root, options, view) = readClient()
+        for path in sorted(readHave().keys()):
+            print "%s#1 - %s" % (path, localFile(path, root, view))
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,14 @@
 #    is a fucking retard...
 
 import datetime
+import multiprocessing
 import os
 import re
 import shutil
 import socket
 import string
 import sys
+import threading
 import time
 import traceback
 import types
@@ -19,11 +21,17 @@ import types
 import pkgutil
 
 
-# initialize the socket callback interface so we have it
-# available..
-serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serversocket.bind((socket.gethostname(), pkgutil.PORT_CREATOR))
-serversocket.listen(16)
+# The socket callback interface, opened by openServerSocket() when the
+# script starts. It is not opened on import, the worker processes of
+# multiprocessing import this module too on Windows and would fail to
+# bind it.
+serversocket = None
+
+def openServerSocket():
+    global serversocket
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.bind((socket.gethostname(), pkgutil.PORT_CREATOR))
+    serversocket.listen(16)
 
 host_linux64 = "tirionvm-linux64.troll.no"
 host_linux32 = "tirionvm-linux32.troll.no"
@@ -31,6 +39,10 @@ host_win64   = "tirionvm-win64.troll.no"
 host_win32   = "packy-win32-jambiclone.troll.no"
 host_mac     = "alqualonde.troll.no"
 
+# The job name of the shared base tree kept on each build server with
+# --shared-upload
+SHARED_BASE = "qtjambi-base"
+
 class Options:
     def __init__(self):
         if pkgutil.isWindows():
@@ -40,8 +52,28 @@ class Options:
         self.eclipseVersion = "1.2.2"
         self.p4User = "qt"
         self.p4Client = "qt-builder"
-        self.binaryPackageCount = 0
+        self.p4Command = "p4"
+        self.incrementalSync = False
+        self.artifactRoot = None
         self.packageExtraName = ""
+        self.expandWorkers = 1
+        self.compressWorkers = 1
+        self.extractWorkers = 1
+        self.compressLevel = pkgutil.COMPRESS_LEVEL
+        self.bundleWorkers = multiprocessing.cpu_count()
+        self.deltaUpload = False
+        self.sharedUpload = False
+        self.only = None
+        self.sharedBaseDigest = None
+        self.postProcessWorkers = 2
+        self.postProcessSlots = None
+        self.cpuTasks = 2
+        self.networkTasks = 2
+        self.hostTasks = 1
+        self.expandCacheDir = None
+        self.expandCacheSize = 512
+        self.expandCacheLink = False
+        self.expandCache = None
 
         self.buildPreview = False;
 
@@ -64,10 +96,56 @@ class Options:
 
 options = Options()
 
+# The rule sets and license headers shared by all packages, see ruleSet
+ruleSets = {}
+licenseHeaders = {}
+
+# Guards the digest of the shared base, see sharedBaseDigest
+sharedBaseLock = threading.Lock()
+
+# Guards the package states while responses come in, see waitForResponse
+responseState = threading.Condition()
+
+
+
+# An immutable set of remove rules: paths of directories and files to
+# remove and patterns, all matched against paths relative to the
+# package with / as separator. The patterns are compiled into one
+# expression when the set is made. Use ruleSet() to get one.
+class RuleSet:
+    def __init__(self, paths, patterns):
+        self.paths = frozenset(paths)
+        self.patterns = tuple(patterns)
+        self.matcher = None
+        if len(self.patterns) > 0:
+            self.matcher = re.compile("|".join(["(?:%s)" % pattern for pattern in self.patterns]))
+
+    # Returns true if the file or directory at path is to be removed
+    def matches(self, path):
+        if path in self.paths:
+            return True
+        return self.matcher is not None and self.matcher.search(path) is not None
+
+
+
+# Returns the RuleSet for the given remove lists. The rule sets are
+# cached, packages with the same lists, which is all the packages of a
+# (platform, binary) profile but for a few license specific entries,
+# share one.
+#  - 0: paths: Directories and files to remove
+#  - 1: patterns: Regular expressions of paths to remove
+def ruleSet(paths, patterns):
+    key = (tuple(sorted(paths)), tuple(patterns))
+    if not key in ruleSets:
+        ruleSets[key] = RuleSet(paths, patterns)
+    return ruleSets[key]
+
 
 class Package:
     def __init__(self, platform, arch, license):
         self.done = False
+        self.sent = False
+        self.received = False
         self.success = False
         self.license = license
         self.platform = platform
@@ -100,27 +178,27 @@ class Package:
             "build_autotests.xml"
             ]
         self.removePatterns = [
-            re.compile("CRT"),
-            re.compile("Makefile$"),
-            re.compile("Makefile.Debug$"),
-            re.compile("Makefile.Release$"),
-            re.compile("\\.a$"),
-            re.compile("\\.class$"),
-            re.compile("\\.debug$"),
-            re.compile("\\.exp$"),
-            re.compile("\\.ilk$"),
-            re.compile("\\.lib$"),
-            re.compile("\\.log$"),
-            re.compile("\\.manifest$"),
-            re.compile("\\.o$"),
-            re.compile("\\.obj$"),
-            re.compile("\\.pch$"),
-            re.compile("\\.pdb$"),
-            re.compile("\\[\\/]debug$"),
-            re.compile("\\[\\/]release$"),
-            re.compile("\\_debuglib\\."),
-            re.compile("com_trolltech.*\\.lib$"),
-            re.compile("task(.bat)?$"),
+            "CRT",
+            "Makefile$",
+            "Makefile.Debug$",
+            "Makefile.Release$",
+            "\\.a$",
+            "\\.class$",
+            "\\.debug$",
+            "\\.exp$",
+            "\\.ilk$",
+            "\\.lib$",
+            "\\.log$",
+            "\\.manifest$",
+            "\\.o$",
+            "\\.obj$",
+            "\\.pch$",
+            "\\.pdb$",
+            "\\[\\/]debug$",
+            "\\[\\/]release$",
+            "\\_debuglib\\.",
+            "com_trolltech.*\\.lib$",
+            "task(.bat)?$",
             ]
 
         self.mkdirs = []
@@ -131,7 +209,9 @@ class Package:
             "dist/install.html",
             "dist/changes-" + options.qtJambiVersion
             ]
-        self.licenseHeader = pkgutil.readLicenseHeader(self.license, options.startDir)
+        if not self.license in licenseHeaders:
+            licenseHeaders[self.license] = pkgutil.readLicenseHeader(self.license, options.startDir)
+        self.licenseHeader = licenseHeaders[self.license]
 
         if self.license == pkgutil.LICENSE_COMMERCIAL:
             self.setCommercial()
@@ -150,11 +230,11 @@ class Package:
         self.binary = True
         self.removeFiles.append("build_generator_example.xml")
         self.removePatterns.extend([
-            re.compile("ant-qtjambi.jar"),
-            re.compile("build.xml$"),
-            re.compile("task.bat$"),
-            re.compile("task.sh$"),
-            re.compile("java.pro")
+            "ant-qtjambi.jar",
+            "build.xml$",
+            "task.bat$",
+            "task.sh$",
+            "java.pro"
             ])
         self.removeDirs.extend([
             "common",
@@ -189,7 +269,7 @@ class Package:
         self.make = "make"
         self.platformJarName = "qtjambi-macosx-gcc-" + options.qtJambiVersion + ".jar"
         self.removeFiles.append("set_qtjambi_env.bat")
-        self.removePatterns.append(re.compile(".*\\.1\\.(\\d\\.)*(jnilib|dylib)$"))
+        self.removePatterns.append(".*\\.1\\.(\\d\\.)*(jnilib|dylib)$")
         if self.license == pkgutil.LICENSE_EVAL:
             self.copyFiles.append("dist/mac/binpatch")
             self.removeDirs.append("Demos.app")
@@ -225,8 +305,8 @@ class Package:
             self.platformJarName = "qtjambi-linux32-gcc-" + options.qtJambiVersion + ".jar"
         self.removeFiles.append("set_qtjambi_env.bat")
         self.removeDirs.append("Demos.app")
-        self.removePatterns.append(re.compile(".*\\.so\\.1(\\.\\d)*$"));
-        # self.removePatterns.append(re.compile("libqtdesigner\\.so\\.4(\\.\\d)*$"));
+        self.removePatterns.append(".*\\.so\\.1(\\.\\d)*$");
+        # self.removePatterns.append("libqtdesigner\\.so\\.4(\\.\\d)*$");
         if self.license == pkgutil.LICENSE_EVAL:
             self.copyFiles.append("dist/linux/binpatch")
 
@@ -320,8 +400,13 @@ class Package:
         else:
             return "qtjambi-src-%s-%s" % (self.license, options.qtJambiVersion)
 
+    # Returns the shared RuleSet for removeDirs, removeFiles and
+    # removePatterns
+    def removeRules(self):
+        return ruleSet(self.removeDirs + self.removeFiles, self.removePatterns)
+
     def writeLog(self, list, subname):
-        logName = os.path.join(options.packageRoot, ".%s.%s" % (self.name(), subname))
+        logName = os.path.join(options.artifactRoot, ".%s.%s" % (self.name(), subname))
         pkgutil.debug("   - log into: " + logName)
         log = open(logName, "w")
         log.write("\n".join(list))
@@ -337,259 +422,269 @@ class Package:
 
 packages = []
 
+# The package matrix. A binary package is made for each of the licenses
+# on each of the platforms and architectures, built on the given host.
+# Source packages are made for each of their licenses and platforms.
+BINARY_MATRIX = [
+    (pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, host_win64),
+    (pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, host_win32),
+    (pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, host_mac),
+    (pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, host_linux64),
+    (pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, host_linux32)
+    ]
+BINARY_LICENSES = [
+    pkgutil.LICENSE_COMMERCIAL,
+    pkgutil.LICENSE_GPL,
+    pkgutil.LICENSE_LGPL,
+    pkgutil.LICENSE_EVAL,
+    pkgutil.LICENSE_PREVIEW
+    ]
+SOURCE_LICENSES = [
+    pkgutil.LICENSE_LGPL,
+    pkgutil.LICENSE_GPL,
+    pkgutil.LICENSE_COMMERCIAL,
+    pkgutil.LICENSE_PREVIEW
+    ]
+SOURCE_PLATFORMS = [
+    pkgutil.PLATFORM_WINDOWS,
+    pkgutil.PLATFORM_LINUX
+    ]
+BINARY_SETUP = {
+    pkgutil.PLATFORM_WINDOWS: Package.setWinBinary,
+    pkgutil.PLATFORM_MAC: Package.setMacBinary,
+    pkgutil.PLATFORM_LINUX: Package.setLinuxBinary
+    }
+
+
+
+# Returns the key a package is selected by with --only, such as
+# linux64-lgpl, mac-commercial or src-linux-lgpl
+#  - 0: platform: The platform of the package
+#  - 1: arch: The architecture, None for source packages
+#  - 2: license: The license of the package
+def packageKey(platform, arch, license):
+    if arch is None:
+        return "src-%s-%s" % (platform, license)
+    if arch == pkgutil.ARCH_UNIVERSAL:
+        arch = ""
+    return "%s%s-%s" % (platform, arch, license)
+
+
+
+# Yields a (key, platform, arch, license, host) tuple for each package
+# in the matrix, in the order they are set up. No packages are created,
+# so it is cheap to filter. arch and host are None for source packages.
+def packageMatrix():
+    for (platform, arch, host) in BINARY_MATRIX:
+        for license in BINARY_LICENSES:
+            yield (packageKey(platform, arch, license), platform, arch, license, host)
+    for license in SOURCE_LICENSES:
+        for platform in SOURCE_PLATFORMS:
+            yield (packageKey(platform, None, license), platform, None, license, None)
+
+
+
+# Returns true if the options select a package of the matrix
+def packageSelected(key, platform, arch, license):
+    if options.only is not None and not key in options.only:
+        return False
+    if arch is None:
+        if not options.buildSource:
+            return False
+    elif not options.buildBinary:
+        return False
+    elif arch == pkgutil.ARCH_64 and not options.build64:
+        return False
+    elif arch == pkgutil.ARCH_32 and not options.build32:
+        return False
+
+    if platform == pkgutil.PLATFORM_WINDOWS:
+        selected = options.buildWindows
+    elif platform == pkgutil.PLATFORM_MAC:
+        selected = options.buildMac
+    else:
+        selected = options.buildLinux
+
+    if license == pkgutil.LICENSE_COMMERCIAL:
+        return selected and options.buildCommercial
+    elif license == pkgutil.LICENSE_GPL:
+        return selected and options.buildGpl
+    elif license == pkgutil.LICENSE_LGPL:
+        return selected and options.buildLgpl
+    elif license == pkgutil.LICENSE_EVAL:
+        return selected and options.buildEval
+    return selected and options.buildPreview
+
 
 
 # Sets up all the various packages to be built into the global
 # variable "packages"
 def setupPackages():
-
-    if options.buildBinary:
-        if options.buildWindows:
-            if options.build64:
-                if options.buildCommercial:
-                    winMoney64 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, pkgutil.LICENSE_COMMERCIAL)
-                    winMoney64.setWinBinary()
-                    winMoney64.buildServer = host_win64;
-                    packages.append(winMoney64)
-                if options.buildGpl:
-                    winFree64 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, pkgutil.LICENSE_GPL)
-                    winFree64.setWinBinary()
-                    winFree64.buildServer = host_win64
-                    packages.append(winFree64)
-                if options.buildLgpl:
-                    winSuperFree64 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, pkgutil.LICENSE_LGPL)
-                    winSuperFree64.setWinBinary()
-                    winSuperFree64.buildServer = host_win64
-                    packages.append(winSuperFree64)
-                if options.buildEval:
-                    winEval64 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, pkgutil.LICENSE_EVAL)
-                    winEval64.setWinBinary()
-                    winEval64.buildServer = host_win64
-                    packages.append(winEval64)
-                if options.buildPreview:
-                    winPreview64 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_64, pkgutil.LICENSE_PREVIEW)
-                    winPreview64.setWinBinary()
-                    winPreview64.buildServer = host_win64
-                    packages.append(winPreview64)
-            if options.build32:
-                if options.buildCommercial:
-                    winMoney32 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, pkgutil.LICENSE_COMMERCIAL)
-                    winMoney32.setWinBinary()
-                    winMoney32.buildServer = host_win32
-                    packages.append(winMoney32)
-                if options.buildGpl:
-                    winFree32 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, pkgutil.LICENSE_GPL)
-                    winFree32.setWinBinary()
-                    winFree32.buildServer = host_win32
-                    packages.append(winFree32)
-                if options.buildLgpl:
-                    winSuperFree32 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, pkgutil.LICENSE_LGPL)
-                    winSuperFree32.setWinBinary()
-                    winSuperFree32.buildServer = host_win32
-                    packages.append(winSuperFree32)
-                if options.buildEval:
-                    winEval32 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, pkgutil.LICENSE_EVAL)
-                    winEval32.setWinBinary()
-                    winEval32.buildServer = host_win32
-                    packages.append(winEval32)
-                if options.buildPreview:
-                    winPreview32 = Package(pkgutil.PLATFORM_WINDOWS, pkgutil.ARCH_32, pkgutil.LICENSE_PREVIEW)
-                    winPreview32.setWinBinary()
-                    winPreview32.buildServer = host_win32
-                    packages.append(winPreview32)
-
-        if options.buildMac:
-            if options.buildCommercial:
-                macMoney = Package(pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, pkgutil.LICENSE_COMMERCIAL)
-                macMoney.setMacBinary()
-                macMoney.buildServer = host_mac
-                packages.append(macMoney)
-            if options.buildGpl:
-                macFree = Package(pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, pkgutil.LICENSE_GPL)
-                macFree.setMacBinary()
-                macFree.buildServer = host_mac
-                packages.append(macFree)
-            if options.buildLgpl:
-                macSuperFree = Package(pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, pkgutil.LICENSE_LGPL)
-                macSuperFree.setMacBinary()
-                macSuperFree.buildServer = host_mac
-                packages.append(macSuperFree)
-            if options.buildEval:
-                macEval = Package(pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, pkgutil.LICENSE_EVAL)
-                macEval.setMacBinary()
-                macEval.buildServer = host_mac
-                packages.append(macEval)
-            if options.buildPreview:
-                macPreview = Package(pkgutil.PLATFORM_MAC, pkgutil.ARCH_UNIVERSAL, pkgutil.LICENSE_PREVIEW)
-                macPreview.setMacBinary()
-                macPreview.buildServer = host_mac
-                packages.append(macPreview)
-
-        if options.buildLinux:
-            if options.build64:
-                if options.buildCommercial:
-                    linuxMoney64 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, pkgutil.LICENSE_COMMERCIAL)
-                    linuxMoney64.setLinuxBinary()
-                    linuxMoney64.buildServer = host_linux64
-                    packages.append(linuxMoney64)
-                if options.buildGpl:
-                    linuxFree64 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, pkgutil.LICENSE_GPL)
-                    linuxFree64.setLinuxBinary()
-                    linuxFree64.buildServer = host_linux64
-                    packages.append(linuxFree64)
-                if options.buildLgpl:
-                    linuxSuperFree64 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, pkgutil.LICENSE_LGPL)
-                    linuxSuperFree64.setLinuxBinary()
-                    linuxSuperFree64.buildServer = host_linux64
-                    packages.append(linuxSuperFree64)
-                if options.buildEval:
-                    linuxEval64 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, pkgutil.LICENSE_EVAL)
-                    linuxEval64.setLinuxBinary()
-                    linuxEval64.buildServer = host_linux64
-                    packages.append(linuxEval64)
-                if options.buildPreview:
-                    linuxPreview64 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_64, pkgutil.LICENSE_PREVIEW)
-                    linuxPreview64.setLinuxBinary()
-                    linuxPreview64.buildServer = host_linux64
-                    packages.append(linuxPreview64)
-            if options.build32:
-                if options.buildCommercial:
-                    linuxMoney32 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, pkgutil.LICENSE_COMMERCIAL)
-                    linuxMoney32.setLinuxBinary()
-                    linuxMoney32.buildServer = host_linux32
-                    packages.append(linuxMoney32)
-                if options.buildGpl:
-                    linuxFree32 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, pkgutil.LICENSE_GPL)
-                    linuxFree32.setLinuxBinary()
-                    linuxFree32.buildServer = host_linux32
-                    packages.append(linuxFree32)
-                if options.buildLgpl:
-                    linuxSuperFree32 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, pkgutil.LICENSE_LGPL)
-                    linuxSuperFree32.setLinuxBinary()
-                    linuxSuperFree32.buildServer = host_linux32
-                    packages.append(linuxSuperFree32)                    
-                if options.buildEval:
-                    linuxEval32 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, pkgutil.LICENSE_EVAL)
-                    linuxEval32.setLinuxBinary()
-                    linuxEval32.buildServer = host_linux32
-                    packages.append(linuxEval32)
-                if options.buildPreview:
-                    linuxPreview32 = Package(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_32, pkgutil.LICENSE_PREVIEW)
-                    linuxPreview32.setLinuxBinary()
-                    linuxPreview32.buildServer = host_linux32
-                    packages.append(linuxPreview32)
-
+    binaryPackages = []
+    sourcePackages = []
+    for (key, platform, arch, license, host) in packageMatrix():
+        if not packageSelected(key, platform, arch, license):
+            continue
+        package = Package(platform, arch, license)
+        if arch is None:
+            package.setSource()
+            sourcePackages.append(package)
+        else:
+            BINARY_SETUP[platform](package)
+            package.buildServer = host
+            binaryPackages.append(package)
 
     # randomize the packages a bit to spread the load better...
     i = 0
-    while i < len(packages):
+    while i < len(binaryPackages):
         fr = i
-        to = (i * 3 + 1) % len(packages)
-        tmp = packages[to]
-        packages[to] = packages[fr]
-        packages[fr] = tmp
+        to = (i * 3 + 1) % len(binaryPackages)
+        tmp = binaryPackages[to]
+        binaryPackages[to] = binaryPackages[fr]
+        binaryPackages[fr] = tmp
         i = i + 1
 
-    if options.buildSource:
-        if options.buildLgpl:
-            if options.buildWindows:
-                winSrcLgpl = Package(pkgutil.PLATFORM_WINDOWS, None, pkgutil.LICENSE_LGPL)
-                winSrcLgpl.setSource()
-                packages.append(winSrcLgpl)
-            if options.buildLinux:
-                linuxSrcLgpl = Package(pkgutil.PLATFORM_LINUX, None, pkgutil.LICENSE_LGPL)
-                linuxSrcLgpl.setSource()
-                packages.append(linuxSrcLgpl)            
-        if options.buildGpl:
-            if options.buildWindows:
-                winSrcGpl = Package(pkgutil.PLATFORM_WINDOWS, None, pkgutil.LICENSE_GPL)
-                winSrcGpl.setSource()
-                packages.append(winSrcGpl)
-            if options.buildLinux:
-                linuxSrcGpl = Package(pkgutil.PLATFORM_LINUX, None, pkgutil.LICENSE_GPL)
-                linuxSrcGpl.setSource()
-                packages.append(linuxSrcGpl)
-        if options.buildCommercial:
-            if options.buildWindows:
-                winSrcMoney = Package(pkgutil.PLATFORM_WINDOWS, None, pkgutil.LICENSE_COMMERCIAL)
-                winSrcMoney.setSource()
-                packages.append(winSrcMoney)
-            if options.buildLinux:
-                linuxSrcMoney = Package(pkgutil.PLATFORM_LINUX, None, pkgutil.LICENSE_COMMERCIAL)
-                linuxSrcMoney.setSource()
-                packages.append(linuxSrcMoney)
-        if options.buildPreview:
-            if options.buildWindows:
-                winSrcPreview = Package(pkgutil.PLATFORM_WINDOWS, None, pkgutil.LICENSE_PREVIEW)
-                winSrcPreview.setSource()
-                packages.append(winSrcPreview)
-            if options.buildLinux:
-                linuxSrcPreview = Package(pkgutil.PLATFORM_LINUX, None, pkgutil.LICENSE_PREVIEW)
-                linuxSrcPreview.setSource()
-                packages.append(linuxSrcPreview)
+    packages.extend(binaryPackages)
+    packages.extend(sourcePackages)
 
     # set some extra properties that depend on the config above...
     for package in packages:
-        package.packageDir = options.packageRoot + "/" + package.name()
+        package.packageDir = options.artifactRoot + "/" + package.name()
 
 
 
 # Sets up the client spec and performs a complete checkout of the
-# tree...
+# tree. With --incremental-sync the existing workspace is kept and only
+# brought up to date, only the artifacts are wiped...
 def prepareSourceTree():
-
-    # remove and recreat dir and cd into it...
-    if os.path.isdir(options.packageRoot):
-        shutil.rmtree(options.packageRoot)
-    os.makedirs(options.packageRoot)
-    os.chdir(options.packageRoot)
+    p4 = "%s -u %s -c %s" % (options.p4Command, options.p4User, options.p4Client)
+
+    # the view of the client, each mapping is synced in its own thread...
+    mappings = [
+        ("//depot/qtjambi/%s/..." % options.qtJambiVersion, "//qt-builder/qtjambi/..."),
+        ("//depot/qt/%s/src/tools/uic/..." % options.qtVersion, "//qt-builder/qt/src/tools/uic/..."),
+        ("//depot/qt/%s/tools/designer/src/lib/..." % options.qtVersion, "//qt-builder/qt/tools/designer/src/lib/..."),
+        ("//depot/eclipse/qtjambi-4.5/...", "//qt-builder/qtjambi/eclipse/qtjambi-4.5/..."),
+        ("//depot/ide/main/shared/designerintegrationv2/...", "//qt-builder/qtjambi/ide/main/shared/designerintegrationv2/..."),
+        ("//depot/ide/main/shared/namespace_global.h", "//qt-builder/qtjambi/ide/main/shared/namespace_global.h")
+        ]
+    depotPaths = [depotPath for (depotPath, clientPath) in mappings]
+
+    # remove and recreate dirs...
+    if options.artifactRoot != options.packageRoot and os.path.isdir(options.artifactRoot):
+        pkgutil.discardTree(options.artifactRoot)
+    if os.path.isdir(options.packageRoot) and not options.incrementalSync:
+        pkgutil.discardTree(options.packageRoot)
+    if not os.path.isdir(options.packageRoot):
+        os.makedirs(options.packageRoot)
+    if not os.path.isdir(options.artifactRoot):
+        os.makedirs(options.artifactRoot)
 
     # set up the perforce client...
-    tmpFile = open("p4spec.tmp", "w")
+    specFile = os.path.join(options.packageRoot, "p4spec.tmp")
+    tmpFile = open(specFile, "w")
     tmpFile.write("Root: %s\n" % (options.packageRoot))
     tmpFile.write("Owner: %s\n" % options.p4User)
     tmpFile.write("Client: %s\n" % options.p4Client)
+    # the workspace is made writable after every sync, clobber lets the
+    # next sync of an incremental run replace those files...
+    tmpFile.write("Options: allwrite clobber nocompress unlocked nomodtime normdir\n")
     tmpFile.write("View:\n")
-    tmpFile.write("        //depot/qtjambi/%s/...  //qt-builder/qtjambi/...\n" % options.qtJambiVersion)
-    tmpFile.write("        //depot/qt/%s/src/tools/uic/...  //qt-builder/qt/src/tools/uic/...\n" % options.qtVersion)
-    tmpFile.write("        //depot/qt/%s/tools/designer/src/lib/...  //qt-builder/qt/tools/designer/src/lib/...\n" % options.qtVersion)
-    tmpFile.write("        //depot/eclipse/qtjambi-4.5/...  //qt-builder/qtjambi/eclipse/qtjambi-4.5/...\n")
-    tmpFile.write("        //depot/ide/main/shared/designerintegrationv2/...  //qt-builder/qtjambi/ide/main/shared/designerintegrationv2/...\n")
-    tmpFile.write("        //depot/ide/main/shared/namespace_global.h  //qt-builder/qtjambi/ide/main/shared/namespace_global.h\n")
+    for (depotPath, clientPath) in mappings:
+        tmpFile.write("        %s  %s\n" % (depotPath, clientPath))
     tmpFile.close()
-    os.system("p4 -u %s -c %s client -i < p4spec.tmp" % (options.p4User, options.p4Client) )
-    os.remove("p4spec.tmp")
+    pkgutil.system("%s client -i < p4spec.tmp" % p4, options.packageRoot)
+    os.remove(specFile)
 
     # sync p4 client spec into subdirectory...
     pkgutil.debug(" - syncing p4...")
-    os.system("p4 -u %s -c %s sync -f //%s/... > .p4sync.buildlog" % (options.p4User, options.p4Client, options.p4Client))
-    os.system("chmod -R a+wX .")
+    if options.incrementalSync:
+        keep = [options.artifactRoot]
+        if options.expandCacheDir:
+            keep.append(options.expandCacheDir)
+        pkgutil.syncWorkspace(p4, options.p4Client, options.packageRoot, "", keep, depotPaths)
+    else:
+        pkgutil.syncPaths(p4, options.packageRoot, depotPaths, "-f")
+    pkgutil.system("chmod -R a+wX .", options.packageRoot)
 
 
+# Makes a source package out of the checkout. This runs in the
+# background while the binary packages are sent and built, and is
+# marked as done in the status like the binary packages. It takes one
+# of the post processing slots the responses of the build servers use,
+# see processResponse.
 def packageSourcePackage(package):
     pkgutil.debug("packaging source package: %s..." % package.name())
 
-    os.chdir(options.packageRoot)
+    options.postProcessSlots.acquire()
+    try:
+        if os.path.isdir(package.packageDir):
+            pkgutil.discardTree(package.packageDir)
+
+        pkgutil.cloneTree(os.path.join(options.packageRoot, "qtjambi"), package.packageDir)
 
-    if os.path.isdir(package.name()):
-        shutil.rmtree(package.name())
+        postProcessPackage(package)
+    finally:
+        options.postProcessSlots.release()
+        responseState.acquire()
+        package.done = True
+        displayStatus()
+        responseState.release()
 
-    shutil.copytree("qtjambi", package.name())
 
-    postProcessPackage(package)
+# Returns the digest of the shared base, which the packages sent
+# against it refer to. It is worked out once for all the hosts.
+def sharedBaseDigest():
+    sharedBaseLock.acquire()
+    try:
+        if options.sharedBaseDigest is None:
+            baseDir = os.path.join(options.packageRoot, "qtjambi")
+            options.sharedBaseDigest = pkgutil.manifestDigest(pkgutil.treeManifest(baseDir))
+    finally:
+        sharedBaseLock.release()
+    return options.sharedBaseDigest
+
+
+
+# Sends the unexpanded source tree to a build server as the shared base
+# for all the packages built there. main runs this once per host, as a
+# task the sends to that host depend on. The base is stored with its
+# digest, so that the server can fail the packages sent against it
+# right away if it cannot store it.
+def sendSharedBase(host):
+    baseDir = os.path.join(options.packageRoot, "qtjambi")
+    pkgutil.debug(" - sending shared base to host: %s.." % host)
+    pkgutil.sendTreeToHost(host, pkgutil.PORT_SERVER, baseDir, SHARED_BASE, options.compressLevel,
+                           options.compressWorkers, options.deltaUpload,
+                           { "store": 1, "basedigest": sharedBaseDigest() })
 
 
-# Creates the build script (.bat or .sh), zips up the file and sends it off to the
-# build server
-def packageAndSend(package):
-    pkgutil.debug("packaging and sending: %s..." % package.name())
 
-    os.chdir(options.packageRoot)
+# Returns the tmptree a package is prepared in before it is sent
+def packageTreeDir(package):
+    return os.path.join(options.artifactRoot, "tmptree-" + package.name())
 
-    if os.path.isdir("tmptree"):
-        shutil.rmtree("tmptree")
 
-    shutil.copytree("qtjambi", "tmptree");
+
+# Creates the tree to send to the build server, with the build script
+# (.bat or .sh) and the expanded sources. Each package is prepared in
+# its own tmptree so that several packages can be prepared at the same
+# time, and one can be prepared while another is being sent.
+#
+# With --shared-upload the tree is not copied, the build server gets the
+# source tree once as a shared base and each package only sends its
+# build script and license header, which the server expands with.
+def createPackageTree(package):
+    pkgutil.debug("packaging: %s..." % package.name())
+
+    treeDir = packageTreeDir(package)
+    if os.path.isdir(treeDir):
+        pkgutil.discardTree(treeDir)
+
+    if options.sharedUpload:
+        os.makedirs(treeDir)
+    else:
+        pkgutil.cloneTree(os.path.join(options.packageRoot, "qtjambi"), treeDir)
 
     qtEdition = "qt-" + package.license;
     if package.license == pkgutil.LICENSE_PREVIEW:
@@ -600,7 +695,7 @@ def packageAndSend(package):
     if arch == pkgutil.ARCH_64:
         arch = "x86_64"
     if package.platform == pkgutil.PLATFORM_WINDOWS:
-        buildFile = open("tmptree/task.bat", "w")
+        buildFile = open(os.path.join(treeDir, "task.bat"), "w")
         buildFile.write("call qt_pkg_setup %s %s\n" % (package.compiler, "c:\\tmp\\qtjambi-package-builder\\" + qtEdition))
 
         # build eclipse on 32-bit windows...
@@ -624,7 +719,7 @@ def packageAndSend(package):
         buildFile.write("copy %QTDIR%\\bin\\QtScript4.dll bin\n")
 
     else:
-        buildFile = open("tmptree/task.sh", "w")
+        buildFile = open(os.path.join(treeDir, "task.sh"), "w")
 
         qtLocation = "/tmp/qtjambi-package-builder/" + qtEdition
         
@@ -673,23 +768,44 @@ def packageAndSend(package):
 
     buildFile.close()
 
+    if options.sharedUpload:
+        headerFile = open(os.path.join(treeDir, pkgutil.HEADER_MEMBER), "w")
+        headerFile.write(package.licenseHeader)
+        headerFile.close()
+        return
+
     pkgutil.debug(" - expanding macroes prior to sending...");
-    pkgutil.expandMacroes("tmptree", package.licenseHeader)
+    pkgutil.expandMacroes(treeDir, package.licenseHeader, options.expandWorkers, options.expandCache)
 
-    zipFile = os.path.join(options.packageRoot, "tmp.zip")
-    pkgutil.debug(" - compressing...")
-    pkgutil.compress(zipFile, os.path.join(options.packageRoot, "tmptree"))
-    pkgutil.debug(" - sending %s to host: %s.." % (package.name(), package.buildServer))
-    pkgutil.sendDataFileToHost(package.buildServer, pkgutil.PORT_SERVER, zipFile)
+
+
+# Zips up the tree made by createPackageTree and sends it off to the
+# build server
+def sendPackageTree(package):
+    treeDir = packageTreeDir(package)
+
+    if options.sharedUpload:
+        baseDigest = sharedBaseDigest()
+        pkgutil.debug(" - sending %s to host: %s against the shared base.." % (package.name(), package.buildServer))
+        pkgutil.sendTreeToHost(package.buildServer, pkgutil.PORT_SERVER, treeDir, package.name(), options.compressLevel,
+                               options.compressWorkers, False, { "base": SHARED_BASE, "basedigest": baseDigest })
+    else:
+        pkgutil.debug(" - compressing and sending %s to host: %s.." % (package.name(), package.buildServer))
+        pkgutil.sendTreeToHost(package.buildServer, pkgutil.PORT_SERVER, treeDir, package.name(), options.compressLevel, options.compressWorkers, options.deltaUpload)
+    pkgutil.discardTree(treeDir)
+
+    responseState.acquire()
+    package.sent = True
+    responseState.release()
 
 
 
 # performs the post-compilation processing of the package
 def postProcessPackage(package):
     pkgutil.debug("Post process package " + package.name())
-    os.chdir(package.packageDir)
+    packageDir = package.packageDir
 
-    if os.path.isfile("FATAL.ERROR"):
+    if os.path.isfile(os.path.join(packageDir, "FATAL.ERROR")):
         print "\nFATAL ERROR on package %s\n" % (package.name())
         return
 
@@ -697,11 +813,11 @@ def postProcessPackage(package):
         doEclipse(package)
     logFile = package.packageDir + "/.task.log"
     if os.path.isfile(logFile):
-        shutil.copy(logFile, options.packageRoot + "/." + package.name() + ".tasklog");
+        shutil.copy(logFile, options.artifactRoot + "/." + package.name() + ".tasklog");
 
     pkgutil.debug(" - creating directories...")
     for mkdir in package.mkdirs:
-        os.makedirs(mkdir)
+        os.makedirs(os.path.join(packageDir, mkdir))
 
     pkgutil.debug(" - copying files around...")
     copyFiles(package)
@@ -712,7 +828,8 @@ def postProcessPackage(package):
     # Patch uic.pri since this does not include all necessary files
     if not package.binary:
         pkgutil.debug(" - patching uic.pri")
-        tmpFile = open("juic/uic.pri", "a")
+        pkgutil.unshareFile(os.path.join(packageDir, "juic/uic.pri"))
+        tmpFile = open(os.path.join(packageDir, "juic/uic.pri"), "a")
         tmpFile.write("\nSOURCES += uic.cpp\n")
         tmpFile.write("HEADERS += uic.h\n")
         tmpFile.close()
@@ -720,54 +837,42 @@ def postProcessPackage(package):
     if package.binary:
         # move platform jar to startdir for webstart, take the examples and classes from windows
         if package.license == pkgutil.LICENSE_LGPL:
-            shutil.copy(package.platformJarName, options.startDir)
+            shutil.copy(os.path.join(packageDir, package.platformJarName), options.startDir)
             if package.platform == pkgutil.PLATFORM_WINDOWS:
-                shutil.copy("qtjambi-%s.jar" % (options.qtJambiVersion), options.startDir);
-                shutil.copy("qtjambi-examples-%s.jar" % (options.qtJambiVersion), options.startDir);
+                shutil.copy(os.path.join(packageDir, "qtjambi-%s.jar" % (options.qtJambiVersion)), options.startDir);
+                shutil.copy(os.path.join(packageDir, "qtjambi-examples-%s.jar" % (options.qtJambiVersion)), options.startDir);
         
         # unjar docs into doc directory...
         pkgutil.debug(" - doing docs...")
-        os.makedirs("doc/html")
-        os.chdir("doc/html")
-        os.system("jar -xf %s/javadoc-%s.jar" % (options.startDir, options.qtJambiVersion) )
-        os.chdir(package.packageDir)
+        docDir = os.path.join(packageDir, "doc/html")
+        os.makedirs(docDir)
+        pkgutil.system("jar -xf %s/javadoc-%s.jar" % (options.startDir, options.qtJambiVersion), docDir)
 
         # unpack the platform .jar to get the correct binary content into
         # the package...
         pkgutil.debug(" - doing native libraries...")
-        os.system("jar -xf %s" % package.platformJarName)
-        shutil.rmtree("%s/META-INF" % package.packageDir)
-        os.remove("qtjambi-deployment.xml")
+        pkgutil.system("jar -xf %s" % package.platformJarName, packageDir)
+        shutil.rmtree("%s/META-INF" % packageDir)
+        os.remove(os.path.join(packageDir, "qtjambi-deployment.xml"))
 
         if package.license == pkgutil.LICENSE_EVAL:
             # Eval packages cannot use platform jar's as these cannot
             # be patched with eval key...
-            os.remove(package.platformJarName)
-
-        if not package.platform == pkgutil.PLATFORM_WINDOWS:
-            os.system("chmod a+rx designer.sh qtjambi.sh")
-            os.system("chmod -R a+rw .")
-            if package.license == pkgutil.LICENSE_EVAL:
-                os.system("chmod a+rx binpatch")
+            os.remove(os.path.join(packageDir, package.platformJarName))
 
         if package.platform == pkgutil.PLATFORM_LINUX:
-            os.chdir("lib")
-            os.system("ln -s libqtjambi.so libqtjambi.so.1")
-            os.chdir(package.packageDir)
+            pkgutil.system("ln -s libqtjambi.so libqtjambi.so.1", os.path.join(packageDir, "lib"))
 
         if package.platform == pkgutil.PLATFORM_MAC:
-            os.chdir("lib")
-            os.system("ln -s libqtjambi.jnilib libqtjambi.1.jnilib")
-            os.chdir(package.packageDir)
-            if not package.license == pkgutil.LICENSE_EVAL:
-                os.system("chmod a+x Demos.app/Contents/MacOS/JavaApplicationStub")
+            pkgutil.system("ln -s libqtjambi.jnilib libqtjambi.1.jnilib", os.path.join(packageDir, "lib"))
 
         if package.platform == pkgutil.PLATFORM_WINDOWS:
-            shutil.copytree("plugins/imageformats/Microsoft.VC80.CRT", "plugins/designer/Microsoft.VC80.CRT");
+            shutil.copytree(os.path.join(packageDir, "plugins/imageformats/Microsoft.VC80.CRT"),
+                            os.path.join(packageDir, "plugins/designer/Microsoft.VC80.CRT"));
 
-    pkgutil.expandMacroes(package.packageDir, package.licenseHeader)
+    expanded = pkgutil.expandMacroes(packageDir, package.licenseHeader, options.expandWorkers, options.expandCache)
  
-    bundle(package)
+    bundle(package, expanded)
 
     package.success = True
 
@@ -776,56 +881,96 @@ def postProcessPackage(package):
 # Goes into the eclipse folder, removes all directories and creates a zip file of the
 # remaining .jar files there..
 def doEclipse(package):
-    os.chdir("eclipse")
+    eclipseDir = os.path.join(package.packageDir, "eclipse")
 
-    shutil.copy("../dist/eclipse/LICENSE.QT_JAMBI_ECLIPSE_INTEGRATION", "LICENSE")
+    shutil.copy(os.path.join(package.packageDir, "dist/eclipse/LICENSE.QT_JAMBI_ECLIPSE_INTEGRATION"),
+                os.path.join(eclipseDir, "LICENSE"))
 
-    for name in os.listdir("qtjambi-4.5"):
-        fullName = os.path.join("qtjambi-4.5", name)
+    pluginDir = os.path.join(eclipseDir, "qtjambi-4.5")
+    for name in os.listdir(pluginDir):
+        fullName = os.path.join(pluginDir, name)
         if os.path.isdir(fullName):
             shutil.rmtree(fullName)
-    shutil.move("qtjambi-4.5", "plugins")
+    shutil.move(pluginDir, os.path.join(eclipseDir, "plugins"))
 
+    bundleName = "%s/qtjambi-eclipse-integration-%s%s-%s" % (options.startDir, package.platform, package.arch, options.qtJambiVersion)
     if package.platform == pkgutil.PLATFORM_WINDOWS:
-        os.system("zip -rq %s/qtjambi-eclipse-integration-%s%s-%s.zip ." % (options.startDir, package.platform, package.arch, options.qtJambiVersion))
+        pkgutil.zipBundle(bundleName + ".zip", eclipseDir, ".", [], pkgutil.COMPRESS_LEVEL, options.bundleWorkers)
     else:
-        os.system("tar -czf %s/qtjambi-eclipse-integration-%s%s-%s.tar.gz --owner=0 --group=0 ." % (options.startDir, package.platform, package.arch, options.qtJambiVersion))
-        
+        pkgutil.tarBundle(bundleName + ".tar.gz", eclipseDir, ".", [], pkgutil.COMPRESS_LEVEL, options.bundleWorkers)
+
 
-    os.chdir(package.packageDir)
     if package.platform == pkgutil.PLATFORM_LINUX:
-        shutil.move("lib/libqtdesignerplugin.so", "lib/libqtdesigner.so");
+        shutil.move(os.path.join(package.packageDir, "lib/libqtdesignerplugin.so"),
+                    os.path.join(package.packageDir, "lib/libqtdesigner.so"));
+
+
+# Returns the mode rules a package is bundled with, see
+# pkgutil.bundleMode. The modes only end up in the bundle, the package
+# directory itself is left as it is. The rules keep the order the chmod
+# calls used to run in: the package is made a+rw before the expansion,
+# which leaves the files it changes at 0755, and bin is made a+x after.
+#  - 0: package: The package
+#  - 1: expanded: The files expandMacroes changed in the package
+def bundleModes(package, expanded):
+    if not package.binary:
+        return []
+    if package.platform == pkgutil.PLATFORM_WINDOWS:
+        return [ (".*", 0111) ]
+
+    modes = [
+        (".*", 0666),
+        ("(designer|qtjambi)\\.sh$", 0555)
+        ]
+    if package.license == pkgutil.LICENSE_EVAL:
+        modes.append(("binpatch$", 0555))
+    elif package.platform == pkgutil.PLATFORM_MAC:
+        modes.append(("Demos\\.app/Contents/MacOS/JavaApplicationStub$", 0111))
+    expandedPaths = set([os.path.relpath(file, package.packageDir).replace(os.sep, "/") for file in expanded])
+    modes.append((expandedPaths, 0755, True))
+    modes.append(("bin(/|$)", 0111))
+    return modes
+
 
 
 # Zips or tars the final content of the package into a bundle in the
 # users root directory...
-def bundle(package):
-    os.chdir(options.packageRoot)
+def bundle(package, expanded):
+    bundleName = "%s/%s%s" % (options.startDir, package.name(), options.packageExtraName)
     if package.platform == pkgutil.PLATFORM_WINDOWS:
-        if package.binary:
-            os.system("chmod -R a+x %s" % package.name())
-        os.system("zip -rq %s/%s%s.zip %s" % (options.startDir, package.name(), options.packageExtraName, package.name()))
+        pkgutil.zipBundle(bundleName + ".zip", options.artifactRoot, package.name(), bundleModes(package, expanded),
+                          pkgutil.COMPRESS_LEVEL, options.bundleWorkers)
     else:
-        if package.binary:
-            os.system("chmod a+x %s/designer.sh" % package.name())
-            os.system("chmod a+x %s/qtjambi.sh" % package.name())
-            os.system("chmod -R a+x %s/bin" % package.name())
-        os.system("tar -czf %s/%s%s.tar.gz --owner=0 --group=0 %s" % (options.startDir, package.name(), options.packageExtraName, package.name()))
+        pkgutil.tarBundle(bundleName + ".tar.gz", options.artifactRoot, package.name(), bundleModes(package, expanded),
+                          pkgutil.COMPRESS_LEVEL, options.bundleWorkers)
+
+
+
+# Copies a file like shutil.copy, unlinking the target first
+#  - 0: source: The file to copy
+#  - 1: target: The file or directory to copy to
+def copyFile(source, target):
+    if os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(source))
+    if os.path.isfile(target):
+        os.remove(target)
+    shutil.copy(source, target)
 
 
 
 # Moves the package content around, such as copying the license files
 # from dist etc. This is mostly specified the variable moveFiles in
-# the package object.
+# the package object. Existing targets are unlinked first, as they may
+# be hardlinked into the source tree by pkgutil.cloneTree.
 def copyFiles(package):
     copylog = []
     for m in package.copyFiles:
         if isinstance(m, types.ListType):
             (source, target) = m;
-            shutil.copy(source, target);
+            copyFile(os.path.join(package.packageDir, source), os.path.join(package.packageDir, target));
             copylog.append("%s -> %s" % (source, target))
         else:
-            shutil.copy(m, package.packageDir)
+            copyFile(os.path.join(package.packageDir, m), package.packageDir)
             copylog.append("%s -> root" % m)
     package.writeLog(copylog, "copylog");
 
@@ -834,82 +979,149 @@ def copyFiles(package):
 # Removing all the unwanted content... The package contains two variables,
 # removeDirs and removeFiles which are used to kill content. removeDirs is removed
 # recursivly and brutally. In addition to the predefined content, we search for a number
-# of regexp patterns and remove that content too.
+# of regexp patterns and remove that content too. Everything is done in one pass
+# over the tree, which does not descend into the directories it removes.
 def removeFiles(package):
-    for (root, dirs, files) in os.walk(package.packageDir, False):
-        for pattern in package.removePatterns:
-            for relfile in files:
-                file = os.path.join(root, relfile)
-                if pattern.search(file):
-                    package.removeFiles.append(file)
-            for reldir in dirs:
-                dir = os.path.join(root, reldir)
-                if pattern.search(dir):
-                    package.removeDirs.append(dir)
-                    
+    packageDir = package.packageDir
+    rules = package.removeRules()
+
     rmlist = [];
-    for fileToRemove in package.removeFiles:
-        try:
-            if os.path.isfile(fileToRemove):
-                os.remove(fileToRemove)
-                rmlist.append("remove file: " + fileToRemove);
-        except:
-            pkgutil.debug("Failed to delete file: " + fileToRemove)
+    for (root, dirs, files) in os.walk(packageDir):
+        relroot = os.path.relpath(root, packageDir).replace(os.sep, "/")
+        if relroot == ".":
+            prefix = ""
+        else:
+            prefix = relroot + "/"
 
-    for dirToRemove in package.removeDirs:
-        try:
-            if os.path.isdir(dirToRemove):
-                shutil.rmtree(dirToRemove)
-                rmlist.append("remove dir: " + dirToRemove)
-        except:
-            pkgutil.debug("Failed to delete directory: " + dirToRemove)
+        for reldir in dirs[:]:
+            if rules.matches(prefix + reldir):
+                dirs.remove(reldir)
+                dirToRemove = os.path.join(root, reldir)
+                try:
+                    pkgutil.removeTree(dirToRemove)
+                    rmlist.append("remove dir: " + dirToRemove)
+                except:
+                    pkgutil.debug("Failed to delete directory: " + dirToRemove)
+
+        for relfile in files:
+            if rules.matches(prefix + relfile):
+                fileToRemove = os.path.join(root, relfile)
+                try:
+                    os.remove(fileToRemove)
+                    rmlist.append("remove file: " + fileToRemove);
+                except:
+                    pkgutil.debug("Failed to delete file: " + fileToRemove)
 
     package.writeLog(rmlist, "removelog")
 
 
 
+# Prints the state of all packages, the source packages are shown as
+# built locally
 def displayStatus():
     print "********************** Server status: ( + = ok, - = not ok, blank = waiting)"
     for pkg in packages:
-        if not pkg.binary:
-            continue
+        if pkg.binary:
+            server = pkg.buildServer
+        else:
+            server = "local"
         status = "   ";
         if pkg.done:
             if pkg.success:
                 status = " + "
             else:
                 status = " - "
-        print "    %s: %s %s" % (status, string.ljust(pkg.buildServer, 30), string.ljust(pkg.name(), 25))
+        print "    %s: %s %s" % (status, string.ljust(server, 30), string.ljust(pkg.name(), 25))
     print "********************"
 
 
 
+# Matches a response received by the ResponseListener with its package
+# and hands it to the post-processing pool.
+def responseReceived(fields, dataFile, host, pool):
+    responseState.acquire()
+    match = None
+    for pkg in packages:
+        if pkg.binary and pkg.name() == fields["job"] and not pkg.received:
+            pkg.received = True
+            match = pkg
+            break
+    responseState.release()
+
+    if not match:
+        print "   - unknown job %s from host %s" % (fields["job"], host)
+        os.remove(dataFile)
+        return
+
+    match.dataFile = options.artifactRoot + "/" + match.name() + ".zip"
+    shutil.move(dataFile, match.dataFile)
+    pool.submit(processResponse, match)
+
+
+
+# Unpacks and post-processes the result of one build server. The
+# source packages are post-processed at the same time, both take one of
+# the --post-process-workers slots, so that no more packages than that
+# are post-processed at once.
+def processResponse(pkg):
+    options.postProcessSlots.acquire()
+    try:
+        pkgutil.debug(" - uncompressing to %s" % (pkg.packageDir))
+        pkgutil.uncompress(pkg.dataFile, pkg.packageDir, options.extractWorkers);
+        postProcessPackage(pkg)
+    except:
+        traceback.print_exc()
+    options.postProcessSlots.release()
+
+    responseState.acquire()
+    pkg.done = True
+    displayStatus()
+    responseState.notifyAll()
+    responseState.release()
+
+
+
+# Receives build server responses on the callback socket. All
+# connections are served from this one thread with pkgutil.serveFrames,
+# complete responses are handed on to responseReceived.
+class ResponseListener(threading.Thread):
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+
+    def run(self):
+        pkgutil.serveFrames(serversocket, options.artifactRoot + "/.partial", self.received)
+
+    def received(self, fields, dataFile, host):
+        pkgutil.debug(" - got response %s from %s" % (fields["job"], host))
+        responseReceived(fields, dataFile, host, self.pool)
+
+
+
+# Starts receiving and post-processing build server responses, which
+# may come in while other packages are still being sent. The pool is
+# not bounded, the listener hands the responses to it from the loop
+# that serves all the connections, which must not block.
+def startResponseListener():
+    pool = pkgutil.WorkerPool(options.postProcessWorkers)
+    ResponseListener(pool).start()
+
+
+
+# Waits for the responses to all the packages that were sent. Packages
+# that failed to be sent are marked as done without success.
 def waitForResponse():
-    packagesRemaining = options.binaryPackageCount
     pkgutil.debug("Waiting for build server responses...")
 
-    while packagesRemaining:
-        displayStatus()
-        (sock, (host, port)) = serversocket.accept()
-        pkgutil.debug(" - got response from %s:%d" % (host, port))
-        match = False
-        for pkg in packages:
-            if pkg.binary and socket.gethostbyname(pkg.buildServer) == host and not pkg.done:
-                pkg.done = True
-                pkg.dataFile = options.packageRoot + "/" + pkg.name() + ".zip"
-                pkgutil.getDataFile(sock, pkg.dataFile)
-                pkgutil.debug(" - uncompressing to %s" % (pkg.packageDir))
-                pkgutil.uncompress(pkg.dataFile, pkg.packageDir);
-                try:
-                    postProcessPackage(pkg)
-                except:
-                    traceback.print_exc()
-                packagesRemaining = packagesRemaining - 1
-                match = True
-                break
-        if not match:
-            print "   - unknown host... %s" % host
+    responseState.acquire()
+    for pkg in packages:
+        if pkg.binary and not pkg.sent:
+            pkg.done = True
     displayStatus()
+    while [pkg for pkg in packages if pkg.binary and not pkg.done]:
+        responseState.wait(10)
+    responseState.release()
 
 
 
@@ -924,11 +1136,12 @@ def signWebstartJars():
         except:
             print "     - did not delete keystore..."
         keystoreInput = "qqqqqq\nTrolltech Developer\nDevelopment\nTrolltech ASA\nOslo\nOslo\nNO\nyes\n\n"
-        inputFile = open("keystore.tmp", "w")
+        inputName = os.path.join(options.artifactRoot, "keystore.tmp")
+        inputFile = open(inputName, "w")
         inputFile.write(keystoreInput)
         inputFile.close()
-        os.system("keytool -genkey -alias trolltech < keystore.tmp")
-        os.remove("keystore.tmp")
+        os.system("keytool -genkey -alias trolltech < %s" % inputName)
+        os.remove(inputName)
 
     for pkg in packages:
         if pkg.binary and pkg.license == pkgutil.LICENSE_GPL and not pkg.arch == pkgutil.ARCH_64:
@@ -952,10 +1165,44 @@ def main():
             options.qtVersion = sys.argv[i+1]
         elif arg == "--package-root":
             options.packageRoot = sys.argv[i+1]
+        elif arg == "--artifact-root":
+            options.artifactRoot = sys.argv[i+1]
+        elif arg == "--incremental-sync":
+            options.incrementalSync = True
+        elif arg == "--p4":
+            options.p4Command = sys.argv[i+1]
         elif arg == "--package-extra-name":
             options.packageExtraName = sys.argv[i+1]
         elif arg == "--qt-jambi-version":
             options.qtJambiVersion = sys.argv[i+1]
+        elif arg == "--post-process-workers":
+            options.postProcessWorkers = int(sys.argv[i+1])
+        elif arg == "--cpu-tasks":
+            options.cpuTasks = int(sys.argv[i+1])
+        elif arg == "--network-tasks":
+            options.networkTasks = int(sys.argv[i+1])
+        elif arg == "--host-tasks":
+            options.hostTasks = int(sys.argv[i+1])
+        elif arg == "--extract-workers":
+            options.extractWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-workers":
+            options.compressWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-level":
+            options.compressLevel = int(sys.argv[i+1])
+        elif arg == "--bundle-workers":
+            options.bundleWorkers = int(sys.argv[i+1])
+        elif arg == "--delta-upload":
+            options.deltaUpload = True
+        elif arg == "--shared-upload":
+            options.sharedUpload = True
+        elif arg == "--expand-workers":
+            options.expandWorkers = int(sys.argv[i+1])
+        elif arg == "--expand-cache":
+            options.expandCacheDir = sys.argv[i+1]
+        elif arg == "--expand-cache-size":
+            options.expandCacheSize = int(sys.argv[i+1])
+        elif arg == "--expand-cache-link":
+            options.expandCacheLink = True
         elif arg == "--no-mac":
             options.buildMac = False
         elif arg == "--no-win":
@@ -986,6 +1233,10 @@ def main():
             pkgutil.VERBOSE = 1
         elif arg == "--preview":
             options.buildPreview = True
+        elif arg == "--only":
+            if options.only is None:
+                options.only = []
+            options.only.extend(sys.argv[i+1].split(","))
 
     if options.buildPreview:
         options.buildGpl = False
@@ -995,15 +1246,33 @@ def main():
 
     options.startDir = os.getcwd()
     options.qtDir = "%s/qt" % options.packageRoot
+    if options.artifactRoot is None:
+        if options.incrementalSync:
+            options.artifactRoot = options.packageRoot + "-artifacts"
+        else:
+            options.artifactRoot = options.packageRoot
 
     pkgutil.debug("Options:")
     print "  - Qt Version: " + options.qtVersion
     print "  - Qt Directory: " + options.qtDir
     print "  - Package Root: " + options.packageRoot
+    print "  - Artifact Root: " + options.artifactRoot
     print "  - Qt Jambi Version: " + options.qtJambiVersion
     print "  - P4 User: " + options.p4User
     print "  - P4 Client: " + options.p4Client
+    print "  - P4 Command: " + options.p4Command
+    print "  - Incremental Sync: %s" % options.incrementalSync
     print "  - Package Extra Name: " + options.packageExtraName
+    print "  - Expand Workers: %d" % options.expandWorkers
+    print "  - Compress Workers: %d, level %d" % (options.compressWorkers, options.compressLevel)
+    print "  - Extract Workers: %d" % options.extractWorkers
+    print "  - Bundle Workers: %d" % options.bundleWorkers
+    print "  - Delta Upload: %s" % options.deltaUpload
+    print "  - Shared Upload: %s" % options.sharedUpload
+    print "  - Post Process Workers: %d" % options.postProcessWorkers
+    print "  - Concurrent Tasks: %d cpu, %d network, %d per host" % (options.cpuTasks, options.networkTasks, options.hostTasks)
+    print "  - Expand Cache: %s (%d MB)" % (options.expandCacheDir, options.expandCacheSize)
+    print "  - Expand Cache Link: %s" % options.expandCacheLink
     print "  - buildMac: %s" % options.buildMac
     print "  - buildWindows: %s" % options.buildWindows
     print "  - buildLinux: %s" % options.buildLinux
@@ -1015,34 +1284,74 @@ def main():
     print "  - build64: %s" % options.build64
     print "  - buildBinary: %s" % options.buildBinary
     print "  - buildSource: %s" % options.buildSource
+    print "  - only: %s" % options.only
     print "  - package for webstart: %s" % options.buildWebstart
     print "  - reset keystore: %s" % options.resetKeystore
     print "  - Preview Packages: %s" % options.buildPreview
 
-    pkgutil.debug("preparing source tree...")
-    prepareSourceTree()
+    if options.only is not None:
+        keys = [entry[0] for entry in packageMatrix()]
+        for key in options.only:
+            if not key in keys:
+                print "Unknown package '%s' in --only, the packages are: %s" % (key, ", ".join(keys))
+                return
+
+    openServerSocket()
+
+    if options.expandCacheDir:
+        options.expandCache = pkgutil.ExpansionCache(options.expandCacheDir, options.expandCacheSize * 1024 * 1024,
+                                                     options.expandCacheLink)
+
+    options.postProcessSlots = threading.Semaphore(options.postProcessWorkers)
 
     pkgutil.debug("configuring packages...");
     setupPackages()
     pkgutil.debug(" - %d packages in total..." % len(packages))
 
+    # Everything after the checkout runs as a graph of tasks: the binary
+    # packages are prepared and sent, at most one at a time per build
+    # server, while the source packages are made locally and the
+    # responses of the build servers come in...
+    graph = pkgutil.TaskGraph({ "cpu": options.cpuTasks, "network": options.networkTasks })
+    prepare = graph.add("prepare source tree", prepareSourceTree, resources=["network"])
 
-    # Package and send all packages, finish off by closing all sockets
-    # to make sure they are properly closed...
-    for package in packages:
-        if package.binary:
-            packageAndSend(package)
-            options.binaryPackageCount = options.binaryPackageCount + 1
-
+    # the source packages start as soon as the checkout is done, they
+    # share the post processing slots with the responses rather than
+    # competing with the binary packages for the cpu ones
     for package in packages:
         if not package.binary:
-            packageSourcePackage(package)
+            graph.add("package " + package.name(), packageSourcePackage, (package,), [prepare])
 
-    if options.binaryPackageCount:
-        waitForResponse()
+    listen = graph.add("start response listener", startResponseListener, depends=[prepare])
 
-    if options.buildBinary and options.buildGpl and options.buildWebstart:
-        signWebstartJars();
+    # with a shared upload each build server gets the base once, before
+    # any of its packages...
+    bases = {}
+    sends = []
+    for package in packages:
+        if package.binary:
+            host = "host:" + package.buildServer
+            graph.setLimit(host, options.hostTasks)
+            depends = [listen]
+            if options.sharedUpload:
+                if not host in bases:
+                    bases[host] = graph.add("send base to " + package.buildServer, sendSharedBase, (package.buildServer,),
+                                            [prepare], resources=["network", host])
+                depends.append(bases[host])
+            create = graph.add("create " + package.name(), createPackageTree, (package,), [prepare], resources=["cpu"])
+            sends.append(graph.add("send " + package.name(), sendPackageTree, (package,), [create] + depends, resources=["network", host]))
+
+    if sends:
+        responses = graph.add("wait for responses", waitForResponse, after=sends)
+        # waiting for the responses runs even if the checkout failed,
+        # there are no jars to sign then...
+        if options.buildBinary and options.buildGpl and options.buildWebstart:
+            graph.add("sign webstart jars", signWebstartJars, depends=[prepare, responses])
+
+    pkgutil.debug("running %d tasks..." % len(graph.tasks))
+    failed = graph.execute()
+    if failed:
+        print "Failed tasks: %s" % ", ".join([task.name for task in failed])
 
 if __name__ == "__main__":
     main()
@@ -10,11 +10,17 @@ import pkgutil
 
 
 
-# initialize the socket callback interface so we have it
-# available..
-serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serversocket.bind((socket.gethostname(), pkgutil.PORT_CREATOR))
-serversocket.listen(16)
+# The socket callback interface, opened by openServerSocket() when the
+# script starts. It is not opened on import, the worker processes of
+# multiprocessing import this module too on Windows and would fail to
+# bind it.
+serversocket = None
+
+def openServerSocket():
+    global serversocket
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.bind((socket.gethostname(), pkgutil.PORT_CREATOR))
+    serversocket.listen(16)
 
 
 
@@ -28,8 +34,20 @@ class Options:
             self.packageRoot = "/tmp/qt-build"
         self.p4User = "qt"
         self.p4Client = "qt-builder"
+        self.p4Command = "p4"
+        self.incrementalSync = False
+        self.artifactRoot = None
         self.startDir = os.getcwd()
         self.p4Resync = True
+        self.expandWorkers = 1
+        self.compressWorkers = 1
+        self.extractWorkers = 1
+        self.compressLevel = pkgutil.COMPRESS_LEVEL
+        self.deltaUpload = False
+        self.expandCacheDir = None
+        self.expandCacheSize = 512
+        self.expandCacheLink = False
+        self.expandCache = None
 
         self.buildMac = True
         self.buildWindows = True
@@ -54,8 +72,6 @@ servers = []
 
 
 def setupServers():
-    os.chdir(options.packageRoot)
-
     if options.buildLinux and options.build32:
         linux32 = BuildServer(pkgutil.PLATFORM_LINUX, pkgutil.ARCH_UNIVERSAL)
         linux32.host = "tirionvm-linux32.troll.no"
@@ -91,19 +107,27 @@ def setupServers():
 # Sets up the client spec and performs a complete checkout of the
 # tree...
 def prepareSourceTree():
-
-    # remove and recreat dir and cd into it...
-    if os.path.isdir(options.packageRoot):
-        shutil.rmtree(options.packageRoot)
-
-    os.makedirs(options.packageRoot)
-    os.chdir(options.packageRoot)
+    p4 = "%s -u %s -c %s" % (options.p4Command, options.p4User, options.p4Client)
+
+    # remove and recreate dirs, an incremental sync keeps the sources...
+    if options.artifactRoot != options.packageRoot and os.path.isdir(options.artifactRoot):
+        pkgutil.discardTree(options.artifactRoot)
+    if os.path.isdir(options.packageRoot) and not options.incrementalSync:
+        pkgutil.discardTree(options.packageRoot)
+    if not os.path.isdir(options.packageRoot):
+        os.makedirs(options.packageRoot)
+    if not os.path.isdir(options.artifactRoot):
+        os.makedirs(options.artifactRoot)
 
     # set up the perforce client...
-    tmpFile = open("p4spec.tmp", "w")
+    specFile = os.path.join(options.packageRoot, "p4spec.tmp")
+    tmpFile = open(specFile, "w")
     tmpFile.write("Root: %s\n" % (options.packageRoot))
     tmpFile.write("Owner: %s\n" % options.p4User)
     tmpFile.write("Client: %s\n" % options.p4Client)
+    # the workspace is made writable after every sync, clobber lets the
+    # next sync of an incremental run replace those files...
+    tmpFile.write("Options: allwrite clobber nocompress unlocked nomodtime normdir\n")
     tmpFile.write("View:\n")
     tmpFile.write("        //depot/qt/%s/...  //%s/qt/...\n" % (options.qtBranch, options.p4Client))
     tmpFile.write("        -//depot/qt/%s/examples/... //qt-builder/qt/examples/...\n" % options.qtBranch)
@@ -114,76 +138,84 @@ def prepareSourceTree():
     tmpFile.write("        -//depot/qt/%s/translations/... //qt-builder/qt/translations/...\n" % options.qtBranch)
     tmpFile.write("        -//depot/qt/%s/dist/... //qt-builder/qt/dist/...\n" % options.qtBranch)
     tmpFile.close()
-    os.system("p4 -u %s -c %s client -i < p4spec.tmp" % (options.p4User, options.p4Client) );
-    os.remove("p4spec.tmp")
+    pkgutil.system("%s client -i < p4spec.tmp" % p4, options.packageRoot);
+    os.remove(specFile)
 
     # sync p4 client spec into subdirectory...
     label = ""
     if options.qtLabel:
         label = "@" + options.qtLabel
     pkgutil.debug(" - syncing p4...")
-    os.system("p4 -u %s -c %s sync -f //%s/... %s > .p4sync.buildlog" % (options.p4User, options.p4Client, options.p4Client, label))
-    os.system("chmod -R u+w .")
+    if options.incrementalSync:
+        keep = [options.artifactRoot]
+        if options.expandCacheDir:
+            keep.append(options.expandCacheDir)
+        pkgutil.syncWorkspace(p4, options.p4Client, options.packageRoot, label, keep)
+    else:
+        pkgutil.system("%s sync -f //%s/... %s > .p4sync.buildlog" % (p4, options.p4Client, label), options.packageRoot)
+    pkgutil.system("chmod -R u+w .", options.packageRoot)
 
 
 
 def packageAndSend(server):
     pkgutil.debug("sending to %s, script=%s..." % (server.host, server.task))
 
-    os.chdir(options.packageRoot)
-
-    if os.path.isdir("tmptree"):
-        shutil.rmtree("tmptree")
-    os.makedirs("tmptree")
+    qtDir = os.path.join(options.packageRoot, "qt")
+    treeDir = os.path.join(options.artifactRoot, "tmptree-" + server.host)
+    if os.path.isdir(treeDir):
+        pkgutil.discardTree(treeDir)
+    os.makedirs(treeDir)
 
     print " - setting up lgpl subdir..."
-    shutil.copytree("qt", "tmptree/lgpl");
-    pkgutil.expandMacroes("tmptree/lgpl", lgpl_header)
+    pkgutil.cloneTree(qtDir, os.path.join(treeDir, "lgpl"))
+    pkgutil.expandMacroes(os.path.join(treeDir, "lgpl"), lgpl_header, options.expandWorkers, options.expandCache)
     
 
     print " - setting up commercial subdir..."
-    shutil.copytree("qt", "tmptree/commercial");
-    pkgutil.expandMacroes("tmptree/commercial", commercial_header)
+    pkgutil.cloneTree(qtDir, os.path.join(treeDir, "commercial"))
+    pkgutil.expandMacroes(os.path.join(treeDir, "commercial"), commercial_header, options.expandWorkers, options.expandCache)
 
 
     if server.platform == pkgutil.PLATFORM_WINDOWS:
-        shutil.copy(server.task, "tmptree/task.bat")
+        shutil.copy(server.task, os.path.join(treeDir, "task.bat"))
     else:
-        shutil.copy(server.task, "tmptree/task.sh")
+        shutil.copy(server.task, os.path.join(treeDir, "task.sh"))
+
+    pkgutil.debug(" - compressing and sending to host: %s.." % (server.host))
+    pkgutil.sendTreeToHost(server.host, pkgutil.PORT_SERVER, treeDir, server.host, options.compressLevel, options.compressWorkers, options.deltaUpload)
+    pkgutil.discardTree(treeDir)
 
-    zipFile = os.path.join(options.packageRoot, "tmp.zip")
-    pkgutil.debug(" - compressing...")
-    pkgutil.compress(zipFile, os.path.join(options.packageRoot, "tmptree"))
-    pkgutil.debug(" - sending to host: %s.." % (server.host))
-    pkgutil.sendDataFileToHost(server.host, pkgutil.PORT_SERVER, zipFile)
+
+
+# Unpacks the result of one build server
+def unpackResponse(server, dataFile):
+    outDir = options.artifactRoot + "/" + server.host;
+    pkgutil.debug(" - uncompressing to %s" % outDir)
+    pkgutil.uncompress(dataFile, outDir, options.extractWorkers);
+
+    if os.path.isfile(outDir + "/FATAL.ERROR"):
+        print "Build server: %s Failed!!!!" % server.host
+    else:
+        print "Build server: %s ok!" % server.host
 
 
 
 def waitForResponse():
-    packagesRemaining = len(servers)
     pkgutil.debug("Waiting for build server responses...")
+    pool = pkgutil.WorkerPool(1)
+    pending = [server.host for server in servers]
 
-    while packagesRemaining:
-        (sock, (host, port)) = serversocket.accept()
-        pkgutil.debug(" - got response from %s:%d" % (host, port))
-        match = False
+    def received(fields, receivedFile, host):
+        pkgutil.debug(" - got response %s from %s" % (fields["job"], host))
         for server in servers:
-            if socket.gethostbyname(server.host) == host:
-                dataFile = options.packageRoot + "/" + server.host + ".zip"
-                outDir = options.packageRoot + "/" + server.host;
-                pkgutil.getDataFile(sock, dataFile)
-                pkgutil.debug(" - uncompressing to %s" % outDir)
-                pkgutil.uncompress(dataFile, outDir);
-
-                if os.path.isfile(outDir + "/FATAL.ERROR"):
-                    print "Build server: %s Failed!!!!" % server.host
-                else:
-                    print "Build server: %s ok!" % server.host
-
-                match = True
+            if server.host == fields["job"] and server.host in pending:
+                pending.remove(server.host)
+                dataFile = options.artifactRoot + "/" + server.host + ".zip"
+                shutil.move(receivedFile, dataFile)
+                pool.submit(unpackResponse, server, dataFile)
 
-        if match:
-            packagesRemaining = packagesRemaining - 1
+    pkgutil.serveFrames(serversocket, options.artifactRoot + "/.partial", received, lambda: len(pending) == 0)
+    pool.join()
 
 
 
@@ -193,10 +225,32 @@ def main():
         arg = sys.argv[i];
         if arg == "--package-root":
             options.packageRoot = sys.argv[i+1]
+        elif arg == "--artifact-root":
+            options.artifactRoot = sys.argv[i+1]
+        elif arg == "--incremental-sync":
+            options.incrementalSync = True
+        elif arg == "--p4":
+            options.p4Command = sys.argv[i+1]
         elif arg == "--qt-branch":
             options.qtBranch = sys.argv[i+1]
         elif arg == "--qt-label":
             options.qtLabel = sys.argv[i+1]
+        elif arg == "--extract-workers":
+            options.extractWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-workers":
+            options.compressWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-level":
+            options.compressLevel = int(sys.argv[i+1])
+        elif arg == "--delta-upload":
+            options.deltaUpload = True
+        elif arg == "--expand-workers":
+            options.expandWorkers = int(sys.argv[i+1])
+        elif arg == "--expand-cache":
+            options.expandCacheDir = sys.argv[i+1]
+        elif arg == "--expand-cache-size":
+            options.expandCacheSize = int(sys.argv[i+1])
+        elif arg == "--expand-cache-link":
+            options.expandCacheLink = True
         elif arg == "--no-p4sync":
             options.p4Resync = False
         elif arg == "--verbose":
@@ -212,13 +266,28 @@ def main():
         elif arg == "--no-64bit":
             options.build64 = False
 
+    if options.artifactRoot is None:
+        if options.incrementalSync:
+            options.artifactRoot = options.packageRoot + "-artifacts"
+        else:
+            options.artifactRoot = options.packageRoot
+
     pkgutil.debug("Options:")
     print "  - Qt Branch: %s" % options.qtBranch
     print "  - Qt Label: %s" % options.qtLabel
     print "  - Package Root: " + options.packageRoot
+    print "  - Artifact Root: " + options.artifactRoot
     print "  - P4 User: " + options.p4User
     print "  - P4 Client: " + options.p4Client
     print "  - P4 Resync: %s" % options.p4Resync
+    print "  - P4 Command: " + options.p4Command
+    print "  - Incremental Sync: %s" % options.incrementalSync
+    print "  - Expand Workers: %d" % options.expandWorkers
+    print "  - Compress Workers: %d, level %d" % (options.compressWorkers, options.compressLevel)
+    print "  - Extract Workers: %d" % options.extractWorkers
+    print "  - Delta Upload: %s" % options.deltaUpload
+    print "  - Expand Cache: %s (%d MB)" % (options.expandCacheDir, options.expandCacheSize)
+    print "  - Expand Cache Link: %s" % options.expandCacheLink
     print "  - buildMac: %s" % options.buildMac
     print "  - buildWindows: %s" % options.buildWindows
     print "  - buildLinux: %s" % options.buildLinux
@@ -229,6 +298,12 @@ def main():
         pkgutil.debug("At the very least, you must specify --qt-branch")
         return
 
+    openServerSocket()
+
+    if options.expandCacheDir:
+        options.expandCache = pkgutil.ExpansionCache(options.expandCacheDir, options.expandCacheSize * 1024 * 1024,
+                                                     options.expandCacheLink)
+
     if options.p4Resync:
         pkgutil.debug("preparing source tree...")
         prepareSourceTree()
@@ -1,22 +1,33 @@
 #!/usr/bin/python
 
 import os
+import re
 import shutil
 import socket
+import subprocess
 import time
 import threading
+import traceback
 import sys
 
 import pkgutil
 
-serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-hostname = socket.gethostname()
-if hostname.find(".") < 0:
-    hostname = hostname + ".troll.no"
-print "binding to " + hostname + ":", pkgutil.PORT_SERVER, "..."
-serversocket.bind((hostname, pkgutil.PORT_SERVER))
-print "listening..."
-serversocket.listen(5)
+# The socket uploads are received on, opened by openServerSocket() when
+# the server starts. It is not opened on import, the worker processes
+# of multiprocessing import this module too on Windows and would fail
+# to bind it.
+serversocket = None
+
+def openServerSocket():
+    global serversocket
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    hostname = socket.gethostname()
+    if hostname.find(".") < 0:
+        hostname = hostname + ".troll.no"
+    print "binding to " + hostname + ":", pkgutil.PORT_SERVER, "..."
+    serversocket.bind((hostname, pkgutil.PORT_SERVER))
+    print "listening..."
+    serversocket.listen(5)
 
 if pkgutil.isWindows():
     rootDir = "c:/tmp/package_server"
@@ -28,108 +39,340 @@ else:
     rootDir = "/tmp/package_server"
     task = ". task.sh > .task.log 2>&1"
 
+partialDir = os.path.join(rootDir, "partial")
+
+# Trees kept from uploads made with the tree, delta or store field, one
+# per job, each with a manifest next to it. They survive restarts so the
+# next delta upload can be applied to them. A kept tree is taken with
+# acquireTree before it is used, several tasks may read it at once
+# while an update has it to itself. treeLock guards the bookkeeping of
+# that, and is notified whenever a tree is released.
+treeRoot = os.path.join(rootDir, "trees")
+treeLock = threading.Condition()
+treeReaders = {}
+treeWriters = {}
+
+# How long an upload made against a shared base waits for that base to
+# arrive, in seconds
+BASE_TIMEOUT = 1800
+
+# The digests of the shared bases that could not be stored, by tree
+# name, so the uploads made against them fail rather than wait for
+# BASE_TIMEOUT. Cleared when the next store for the tree is applied.
+# Guarded by treeLock.
+failedBases = {}
+
 pendingTasks = []
 waitCondition = threading.Condition()
-startDir = os.getcwd()
 
 cleanTmp = True
-
+jobCount = 1
+compressWorkers = 1
+extractWorkers = 1
+expandWorkers = 1
+compressLevel = pkgutil.COMPRESS_LEVEL
+
+# Receives uploads on serversocket. All connections are served from
+# this one thread with pkgutil.serveFrames, each upload is streamed to
+# disk and queued as a task once it is complete.
 class SocketListener(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         self.setDaemon(True)
+        self.taskCount = 0
 
     def run(self):
-        while 1:
-            print "listener: waiting for socket accept..."
-            (clientsocket, (host, port) ) = serversocket.accept()
-            print "listener: got connection: %s on %s:%d" % (clientsocket, host, port)
+        print "listener: waiting for uploads..."
+        pkgutil.serveFrames(serversocket, partialDir, self.uploadReceived, lookup=self.manifestRequested)
 
-            path = "%s/%d" % (rootDir, port)
+    def manifestRequested(self, fields):
+        return os.path.join(treeRoot, treeName(fields["job"]) + ".manifest")
 
-            if os.path.isdir(path):
-                shutil.rmtree(path)
-            os.makedirs(path)
+    def uploadReceived(self, fields, zipFileName, host):
+        print "listener: got %s from %s" % (fields["job"], host)
+        self.taskCount = self.taskCount + 1
+        path = "%s/%d" % (rootDir, self.taskCount)
 
-            zipFileName = os.path.join(path, "tmp.zip")
-            pkgutil.getDataFile(clientsocket, zipFileName)
-            print "listener: uncompressing %s from %s" % (path, zipFileName)
-            pkgutil.uncompress(zipFileName, path)
-            os.remove(zipFileName)
+        taskDef = (task, path, host, fields, zipFileName)
+        print "listener: aquiring lock for task push"
+        waitCondition.acquire()
+        pendingTasks.append(taskDef)
+        print "listener: aquiring lock for notify/release after task push"
+        waitCondition.notify()
+        waitCondition.release()
 
-            taskDef = (task, path, host)
-            print "listener: aquiring lock for task push"
-            waitCondition.acquire()
-            pendingTasks.append(taskDef)
-            print "listener: aquiring lock for notify/release after task push"
-            waitCondition.notify()
-            waitCondition.release()
 
 
+# Returns the name of the kept tree for a job
+def treeName(jobId):
+    return re.sub("[^\\w.-]", "_", jobId)
 
-def runTask(taskDef):
-    (task, path, host) = taskDef
 
-    print "runTask:\n - command='%s'\n - directory='%s'\n - host='%s'" % taskDef
 
-    os.chdir(path)
+# Takes the kept tree name for reading, or for writing with write set.
+# Readers share the tree, a writer waits until they are done and keeps
+# new readers out from the moment it asks. Must not be called with
+# treeLock held.
+def acquireTree(name, write=False):
+    treeLock.acquire()
+    try:
+        while name in treeWriters:
+            treeLock.wait(10)
+        if write:
+            treeWriters[name] = 1
+            while treeReaders.get(name):
+                treeLock.wait(10)
+        else:
+            treeReaders[name] = treeReaders.get(name, 0) + 1
+    finally:
+        treeLock.release()
+
+
+
+# Releases a tree taken with acquireTree
+def releaseTree(name, write=False):
+    treeLock.acquire()
+    try:
+        if write:
+            del treeWriters[name]
+        elif treeReaders[name] > 1:
+            treeReaders[name] = treeReaders[name] - 1
+        else:
+            del treeReaders[name]
+        treeLock.notifyAll()
+    finally:
+        treeLock.release()
+
+
+
+# Applies an upload to the tree kept for its job. An upload with the
+# delta field is applied on top of the kept tree, any other replaces it.
+# Returns the directory of the tree, or None if the delta was made
+# against a different tree than the one kept. The kept tree is dropped
+# then so the next upload is a full one. Must be called with the tree
+# taken for writing, see acquireTree.
+def updateTree(fields, zipFileName):
+    treeDir = os.path.join(treeRoot, treeName(fields["job"]))
+    manifestFile = treeDir + ".manifest"
+
+    if "delta" in fields:
+        manifest = pkgutil.readManifest(manifestFile)
+        if pkgutil.manifestDigest(manifest) != fields["delta"]:
+            print "runTask: delta for %s does not match the kept tree" % fields["job"]
+            if os.path.isfile(manifestFile):
+                os.remove(manifestFile)
+            if os.path.isdir(treeDir):
+                pkgutil.discardTree(treeDir)
+            return None
+    else:
+        if os.path.isdir(treeDir):
+            pkgutil.discardTree(treeDir)
+        manifest = {}
+
+    print "runTask: applying %s to %s" % (zipFileName, treeDir)
+    pkgutil.applyDelta(zipFileName, treeDir, manifest, extractWorkers)
+    pkgutil.writeManifest(manifestFile, manifest)
+    return treeDir
+
+
+
+# Applies an upload to the tree kept for its job and clones the tree to
+# path for the task to run in. Only the tree of the job is held while
+# this is done, the tasks of other jobs are prepared side by side.
+# Returns an error message if the upload could not be applied, None
+# otherwise.
+def prepareFromTree(path, fields, zipFileName):
+    name = treeName(fields["job"])
+    acquireTree(name, True)
+    try:
+        treeDir = updateTree(fields, zipFileName)
+        if treeDir is None:
+            return "Delta upload does not match the tree kept on the server, the next upload will be a full one"
+        shutil.rmtree(path)
+        pkgutil.cloneTree(treeDir, path, False)
+    finally:
+        releaseTree(name, True)
+    return None
+
+
+
+# Materializes the tree for an upload made against a shared base: the
+# kept base tree is cloned into path, the upload is applied on top of it
+# and the result is expanded with the license header it carries. The
+# clone shares no inodes with the base, the task may write to any file
+# in it. The base is only taken for reading while it is cloned, so the
+# uploads for one host are prepared side by side. Waits for the base
+# the upload was made against, as it may still be on its way. Returns
+# an error message if the tree could not be made, None otherwise.
+def prepareFromBase(path, fields, zipFileName):
+    name = treeName(fields["base"])
+    baseDir = os.path.join(treeRoot, name)
+
+    start = time.time()
+    while 1:
+        acquireTree(name)
+        if pkgutil.manifestDigest(pkgutil.readManifest(baseDir + ".manifest")) == fields["basedigest"]:
+            break
+        releaseTree(name)
+        treeLock.acquire()
+        try:
+            if failedBases.get(name) == fields["basedigest"]:
+                return "Shared base %s could not be stored on the server, the next upload will be a full one" % fields["base"]
+            if time.time() - start >= BASE_TIMEOUT:
+                return "Shared base %s never arrived on the server" % fields["base"]
+            print "runTask: %s waiting for base %s..." % (fields["job"], fields["base"])
+            treeLock.wait(10)
+        finally:
+            treeLock.release()
+
+    try:
+        shutil.rmtree(path)
+        print "runTask: cloning %s to %s" % (baseDir, path)
+        pkgutil.cloneTree(baseDir, path, False)
+    finally:
+        releaseTree(name)
+
+    pkgutil.applyDelta(zipFileName, path, {}, extractWorkers)
+    headerFile = os.path.join(path, pkgutil.HEADER_MEMBER)
+    fh = open(headerFile, "r")
+    header = fh.read()
+    fh.close()
+    os.remove(headerFile)
+    pkgutil.expandMacroes(path, header, expandWorkers)
+    return None
 
-    exitCode = os.system(task)
 
-    if exitCode:
+
+def runTask(taskDef):
+    (task, path, host, fields, zipFileName) = taskDef
+    jobId = fields["job"]
+
+    print "runTask:\n - command='%s'\n - directory='%s'\n - host='%s'\n - job='%s'\n - data='%s'" % (task, path, host, jobId, zipFileName)
+
+    # a shared base is only kept, there is nothing to run...
+    if "store" in fields:
+        name = treeName(jobId)
+        acquireTree(name, True)
+        try:
+            treeDir = updateTree(fields, zipFileName)
+        finally:
+            releaseTree(name, True)
+        treeLock.acquire()
+        if treeDir is None:
+            # let the uploads waiting for this base fail right away...
+            failedBases[name] = fields.get("basedigest")
+        elif name in failedBases:
+            del failedBases[name]
+        treeLock.notifyAll()
+        treeLock.release()
+        os.remove(zipFileName)
+        return
+
+    if os.path.isdir(path):
+        pkgutil.discardTree(path)
+    os.makedirs(path)
+
+    if "base" in fields:
+        error = prepareFromBase(path, fields, zipFileName)
+    elif "tree" in fields or "delta" in fields:
+        error = prepareFromTree(path, fields, zipFileName)
+    else:
+        print "runTask: uncompressing %s from %s" % (path, zipFileName)
+        pkgutil.uncompress(zipFileName, path, extractWorkers)
+        error = None
+    os.remove(zipFileName)
+
+    if error is None:
+        exitCode = subprocess.call(task, shell=True, cwd=path)
+        if exitCode:
+            fh = open(os.path.join(path, "FATAL.ERROR"), "w")
+            fh.write("Exit code: %d\n" % exitCode)
+            fh.close()
+    else:
         fh = open(os.path.join(path, "FATAL.ERROR"), "w")
-        fh.write("Exit code: %d\n" % exitCode)
+        fh.write(error + "\n")
         fh.close()
 
-    resultZipFile = path + ".zip"
-
-    print "runTask: - completed, compressing..."
+    print "runTask: - completed, compressing and sending..."
     callbackFail = False
     try:
-        pkgutil.compress(resultZipFile, path)
-        pkgutil.sendDataFileToHost(host, pkgutil.PORT_CREATOR, resultZipFile)
-    except socket.error, (error, message):
-        print "socket error, %s" % (message)
+        pkgutil.sendTreeToHost(host, pkgutil.PORT_CREATOR, path, jobId, compressLevel, compressWorkers)
+    except (socket.error, pkgutil.TransferError), e:
+        print "socket error, %s" % e
         callbackFail = True
 
     if cleanTmp and not callbackFail:
         try:
-            os.chdir(startDir)
-            os.remove(resultZipFile)
-            shutil.rmtree(path)
+            pkgutil.discardTree(path)
         except OSError:
             print " - runTask: failed to clean up, cause='%s'" % OSError
 
 
 
+# Picks tasks off pendingTasks and runs them. jobCount of these run
+# side by side, each task has its own directory so they do not
+# interfere with each other.
+class TaskRunner(threading.Thread):
+    def __init__(self, index):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.index = index
+
+    def run(self):
+        while 1:
+            waitCondition.acquire()
+            while len(pendingTasks) == 0:
+                print "runner %d: waiting..." % self.index
+                waitCondition.wait()
+            todo = pendingTasks[0]
+            del pendingTasks[0]
+            waitCondition.release()
+            print "runner %d: woke up..." % self.index
+            try:
+                runTask(todo)
+            except:
+                traceback.print_exc()
+
+
+
 if __name__ == "__main__":
 
-    for arg in sys.argv:
+    for i in range(0, len(sys.argv)):
+        arg = sys.argv[i]
         if arg == "--keep-tmp":
             cleanTmp = False
+        elif arg == "--jobs":
+            jobCount = int(sys.argv[i+1])
+        elif arg == "--extract-workers":
+            extractWorkers = int(sys.argv[i+1])
+        elif arg == "--expand-workers":
+            expandWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-workers":
+            compressWorkers = int(sys.argv[i+1])
+        elif arg == "--compress-level":
+            compressLevel = int(sys.argv[i+1])
+
+    openServerSocket()
+
+    # some initial cleanup, the kept trees stay for the next delta...
+    if os.path.isdir(rootDir) and cleanTmp:
+        for name in os.listdir(rootDir):
+            if name != os.path.basename(treeRoot):
+                if os.path.isdir(os.path.join(rootDir, name)):
+                    pkgutil.discardTree(os.path.join(rootDir, name))
+                else:
+                    os.remove(os.path.join(rootDir, name))
+        if os.path.isdir(treeRoot):
+            for name in os.listdir(treeRoot):
+                if name.find(".discard-") >= 0:
+                    pkgutil.discardTree(os.path.join(treeRoot, name))
 
     socketListener = SocketListener()
     socketListener.start()
 
-    # some initial cleanup...
-    if os.path.isdir(rootDir) and cleanTmp:
-        shutil.rmtree(rootDir)
+    print "starting %d task runners..." % jobCount
+    for i in range(0, jobCount):
+        TaskRunner(i).start()
 
     while 1:
-        print "mt: aquired lock..."
-        waitCondition.acquire()
-        if len(pendingTasks) == 0:
-            print "mt: waiting..."
-            waitCondition.wait()
-            print "mt: woke up..."
-
-        if len(pendingTasks) == 0:
-            print "mt: no pending tasks after all this time..."
-
-        todo = pendingTasks[0]
-        del pendingTasks[0]
-        waitCondition.release()
-        runTask(todo)
-
-
-
+        time.sleep(3600)
@@ -1,9 +1,29 @@
+import asyncore
+import cStringIO
 import datetime
+import hashlib
+import multiprocessing
 import os
 import platform
+import Queue
 import re
+import shutil
 import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import traceback
 import zipfile
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 VERBOSE = 1
 PORT_SERVER = 8184
@@ -23,6 +43,58 @@ LICENSE_EVAL = "eval"
 LICENSE_COMMERCIAL = "commercial"
 LICENSE_PREVIEW = "preview"
 
+# Number of files handed to a worker process at a time when expanding
+# macroes in parallel
+EXPAND_CHUNK_SIZE = 64
+
+# Size of the blocks used when sending and receiving files
+TRANSFER_BLOCK_SIZE = 256 * 1024
+
+# The first word of every frame header, see sendFramed/FrameChannel
+FRAME_MAGIC = "QTJ1"
+MAX_FRAME_HEADER = 4096
+
+# How often and how long apart sendDataFileToHost retries a transfer
+# that was interrupted
+TRANSFER_RETRIES = 5
+TRANSFER_RETRY_DELAY = 10
+
+# Default deflate level for compressMembers(), and the file size above
+# which a member is streamed from the main process instead of being
+# deflated in a worker
+COMPRESS_LEVEL = 6
+COMPRESS_STREAM_SIZE = 32 * 1024 * 1024
+
+# Size of the independently deflated gzip members of a tarBundle()
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Member of a delta upload listing the files that were removed from the
+# tree, one per line, see sendTreeToHost and applyDelta
+DELTA_MEMBER = ".qtjambi-delta"
+
+# Member of an upload made against a shared base tree holding the
+# license header the tree is to be expanded with on the server
+HEADER_MEMBER = ".qtjambi-header"
+
+# Matches a line of "p4 have" output, the local file is the group
+P4_HAVE_PATTERN = re.compile("^//.*#\\d+ - (.*)$")
+
+# Matches a line of "p4 sync" output for a file that was written, the
+# local file is the group
+P4_SYNC_PATTERN = re.compile("^//.*#\\d+ - (?:added as|updating|refreshing|replacing) (.*)$")
+
+# How many files syncPaths fetches between progress reports
+P4_PROGRESS_INTERVAL = 1000
+
+# Number of threads removeTree deletes files in, and the number of
+# files handed to a thread at a time
+DELETE_WORKERS = 8
+DELETE_CHUNK_SIZE = 256
+
+# The Linux ioctl that makes a file share the extents of another one,
+# used by cloneTree on file systems that support reflinks
+FICLONE = 0x40049409
+
 CMD_RESET = "R";
 CMD_NEWPKG = "N";
 
@@ -34,110 +106,1644 @@ def debug(str):
 
 
 
-# Compresses a directory into a zipfile
-#  - 0: zipFile: The name of the output file...
-#  - 1: zipRoot: The directory to zip down
-def compress(zipFile, zipRoot):
-    def zipHelper(unused, dir, fileList):
-        for file in fileList:
-            absFile = (dir + "/" + file)[len(zipRoot) + 1:]
+# Runs a shell command in the given directory, like os.system but
+# without changing the current directory of the process. Returns the
+# exit code of the command.
+#  - 0: command: The command line to run
+#  - 1: cwd: The directory to run it in
+def system(command, cwd):
+    return subprocess.call(command, shell=True, cwd=cwd)
+
+
+
+# Runs a shell command in the given directory and returns its output
+# as a list of lines
+#  - 0: command: The command line to run
+#  - 1: cwd: The directory to run it in
+def systemLines(command, cwd):
+    process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    return output.splitlines()
+
+
+
+# Returns the local files of the revisions a perforce client has, as a
+# set of normalized absolute paths
+#  - 0: p4: The p4 command line including user and client options
+#  - 1: client: The client name
+#  - 2: root: The client root
+def p4Have(p4, client, root):
+    have = set()
+    for line in systemLines("%s have //%s/..." % (p4, client), root):
+        match = P4_HAVE_PATTERN.match(line)
+        if match:
+            have.add(os.path.normcase(os.path.normpath(match.group(1))))
+    return have
+
+
+
+# Syncs several depot paths of a perforce client side by side, one
+# thread per path, reporting progress per path. The output of all the
+# syncs is written to .p4sync.buildlog in root, one path after the
+# other. Returns a list of (path, files, bytes) tuples in the order of
+# paths.
+#  - 0: p4: The p4 command line including user and client options
+#  - 1: root: The client root
+#  - 2: paths: The depot paths to sync, they should not overlap
+#  - 3: flags: Options for p4 sync, like "-f"
+#  - 4: revision: Optional revision to sync to, like "@label"
+def syncPaths(p4, root, paths, flags="", revision=""):
+    results = [None] * len(paths)
+    output = [None] * len(paths)
+
+    def syncPath(index):
+        path = paths[index]
+        start = time.time()
+        process = subprocess.Popen("%s sync %s %s%s" % (p4, flags, path, revision), shell=True, cwd=root,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        lines = []
+        files = 0
+        bytes = 0
+        for line in process.stdout:
+            lines.append(line)
+            match = P4_SYNC_PATTERN.match(line.rstrip())
+            if match and os.path.isfile(match.group(1)):
+                files = files + 1
+                bytes = bytes + os.path.getsize(match.group(1))
+                if files % P4_PROGRESS_INTERVAL == 0:
+                    debug("   - syncPaths: %s, %d files, %d bytes so far..." % (path, files, bytes))
+        process.wait()
+        output[index] = lines
+        results[index] = (path, files, bytes)
+        debug("   - syncPaths: %s done, %d files, %d bytes in %.1f seconds" % (path, files, bytes, time.time() - start))
+
+    pool = WorkerPool(len(paths))
+    for i in range(0, len(paths)):
+        pool.submit(syncPath, i)
+    pool.close()
+
+    log = open(os.path.join(root, ".p4sync.buildlog"), "w")
+    for lines in output:
+        if lines:
+            log.writelines(lines)
+    log.close()
+    return results
+
+
+
+# Brings an existing perforce workspace up to date without fetching
+# what it already has. Changed revisions are synced, files that were
+# modified or deleted locally are force synced, and files perforce does
+# not know about are removed. Returns the number of files removed.
+#  - 0: p4: The p4 command line including user and client options
+#  - 1: client: The client name
+#  - 2: root: The client root
+#  - 3: revision: Optional revision to sync to, like "@label"
+#  - 4: keep: Absolute paths of files and directories never to remove
+#  - 5: paths: Depot paths to sync in parallel, see syncPaths, the
+#       whole client by default
+def syncWorkspace(p4, client, root, revision="", keep=[], paths=None):
+    debug("   - syncWorkspace: syncing changed revisions...")
+    if paths is None:
+        paths = ["//%s/..." % client]
+    syncPaths(p4, root, paths, "", revision)
+
+    changed = systemLines("%s diff -se //%s/..." % (p4, client), root)
+    changed.extend(systemLines("%s diff -sd //%s/..." % (p4, client), root))
+    if len(changed) > 0:
+        debug("   - syncWorkspace: force syncing %d locally changed files..." % len(changed))
+        listFile = os.path.join(root, ".p4changed.tmp")
+        file = open(listFile, "w")
+        file.write("\n".join(changed) + "\n")
+        file.close()
+        system("%s -x .p4changed.tmp sync -f >> .p4sync.buildlog" % p4, root)
+        os.remove(listFile)
+
+    have = p4Have(p4, client, root)
+    keep = [os.path.normcase(os.path.normpath(path)) for path in keep]
+    keep.append(os.path.normcase(os.path.normpath(os.path.join(root, ".p4sync.buildlog"))))
+    removed = 0
+    visited = []
+    for (dir, dirs, files) in os.walk(root):
+        for name in dirs[:]:
+            subdir = os.path.normcase(os.path.normpath(os.path.join(dir, name)))
+            if subdir in keep:
+                dirs.remove(name)
+            elif os.path.islink(subdir) and not subdir in have:
+                os.remove(subdir)
+                removed = removed + 1
+        visited.append(dir)
+        for name in files:
+            file = os.path.normcase(os.path.normpath(os.path.join(dir, name)))
+            if not file in have and not file in keep:
+                os.remove(file)
+                removed = removed + 1
+
+    # remove the directories that were left empty, deepest first...
+    for dir in reversed(visited[1:]):
+        if len(os.listdir(dir)) == 0:
+            os.rmdir(dir)
+    debug("   - syncWorkspace: removed %d stale files" % removed)
+    return removed
+
+
+
+# Deflates a single file for compressMembers(). This is the unit of work
+# handed to the worker processes. Returns a tuple of (arcname, stat,
+# crc, uncompressed size, compressed data).
+#  - 0: job: A (absFile, arcname, level) tuple
+def deflateMember(job):
+    (absFile, arcname, level) = job
+    file = open(absFile, "rb")
+    data = file.read()
+    file.close()
+    crc = zlib.crc32(data) & 0xffffffff
+    size = len(data)
+    if level > 0:
+        deflater = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = deflater.compress(data) + deflater.flush()
+    return (arcname, os.stat(absFile), crc, size, data)
+
+
+
+# Creates the ZipInfo for a member of compressMembers(). The mode is taken
+# from stat unless it is given.
+def memberInfo(arcname, stat, level, mode=None):
+    if mode is None:
+        mode = stat.st_mode
+    zinfo = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[0:6])
+    zinfo.external_attr = (mode & 0xFFFF) << 16L
+    if level > 0:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+    else:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    return zinfo
+
+
+
+# Appends a member to a zipfile opened for writing, with data that has
+# been compressed already. The file is written strictly sequentially,
+# it is never seeked. This is the only function that uses the internals
+# of zipfile (ZipFile.fp, _writecheck, _didModify and
+# ZipInfo.FileHeader): the public API compresses members itself and
+# seeks back to patch their headers, which neither the worker processes
+# of compressMembers nor a FrameWriter allow. The internals are those
+# of python 2.7, test_zip.py checks the result reads back.
+#
+# With bit 3 set in zinfo.flag_bits the CRC and sizes follow the data
+# in a data descriptor, and blocks sets them in zinfo as it runs out.
+#  - 0: zip: The ZipFile
+#  - 1: zinfo: The ZipInfo from memberInfo(), with the CRC and sizes set
+#       unless they follow in a data descriptor
+#  - 2: blocks: The compressed data, a sequence or iterator of strings
+def writeRawMember(zip, zinfo, blocks):
+    if sys.version_info[:2] != (2, 7):
+        raise RuntimeError("writeRawMember relies on the zipfile module of python 2.7")
+    zinfo.header_offset = zip.fp.tell()
+    zip._writecheck(zinfo)
+    zip._didModify = True
+    zip.fp.write(zinfo.FileHeader())
+    for block in blocks:
+        zip.fp.write(block)
+    if zinfo.flag_bits & 0x08:
+        zip.fp.write(struct.pack("<LLLL", 0x08074b50, zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+    zip.filelist.append(zinfo)
+    zip.NameToInfo[zinfo.filename] = zinfo
+
+
+
+# Appends an already deflated member to a zipfile opened for writing,
+# see writeRawMember
+#  - 0: zip: The ZipFile
+#  - 1: zinfo: The ZipInfo from memberInfo()
+#  - 2: crc: The CRC-32 of the uncompressed data
+#  - 3: size: The uncompressed size
+#  - 4: data: The compressed data
+def writeMember(zip, zinfo, crc, size, data):
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    writeRawMember(zip, zinfo, [data])
+
+
+
+# Deflates a large file straight into a zipfile opened for writing,
+# without holding it in memory. The sizes and CRC follow the data in a
+# data descriptor, so the file is never seeked.
+#  - 0: zip: The ZipFile
+#  - 1: absFile: The file to add
+#  - 2: arcname: The name of the member
+#  - 3: level: The deflate level, 0 stores the file
+#  - 4: mode: The mode to store, None for the mode of the file
+def streamMember(zip, absFile, arcname, level, mode=None):
+    zinfo = memberInfo(arcname, os.stat(absFile), level, mode)
+    zinfo.flag_bits = zinfo.flag_bits | 0x08
+    zinfo.file_size = 0
+    zinfo.compress_size = 0
+    zinfo.CRC = 0
+
+    def blocks():
+        deflater = None
+        if level > 0:
+            deflater = zlib.compressobj(level, zlib.DEFLATED, -15)
+        crc = 0
+        file = open(absFile, "rb")
+        block = file.read(TRANSFER_BLOCK_SIZE)
+        while len(block) > 0:
+            crc = zlib.crc32(block, crc)
+            zinfo.file_size = zinfo.file_size + len(block)
+            if deflater:
+                block = deflater.compress(block)
+            zinfo.compress_size = zinfo.compress_size + len(block)
+            yield block
+            block = file.read(TRANSFER_BLOCK_SIZE)
+        file.close()
+        if deflater:
+            block = deflater.flush()
+            zinfo.compress_size = zinfo.compress_size + len(block)
+            yield block
+        zinfo.CRC = crc & 0xffffffff
+
+    writeRawMember(zip, zinfo, blocks())
+
+
+
+# Returns a sorted list of (absFile, arcname) pairs for all the files
+# below zipRoot
+def listMembers(zipRoot):
+    members = []
+    for (root, dirs, files) in os.walk(zipRoot):
+        dirs.sort()
+        for name in sorted(files):
+            absFile = os.path.join(root, name)
             if os.path.isfile(absFile):
-                zip.write(absFile);
-    os.chdir(zipRoot);
-    zip = zipfile.ZipFile(zipFile, "w", zipfile.ZIP_DEFLATED);
-    os.path.walk(zipRoot, zipHelper, 'somenull')
+                members.append((absFile, os.path.relpath(absFile, zipRoot)))
+    return members
+
+
+
+# Writes members into an open ZipFile. Files are deflated in a pool of
+# worker processes and written in order as they complete, files larger
+# than COMPRESS_STREAM_SIZE are streamed from this process.
+#  - 0: zip: The ZipFile opened for writing
+#  - 1: members: List of (absFile, arcname) pairs
+#  - 2: level: The deflate level, 0 stores the files
+#  - 3: workers: The number of processes to deflate in, 1 means serial
+#  - 4: modes: Dictionary of arcname to the mode to store instead of
+#       the mode of the file
+def compressMembers(zip, members, level, workers, modes={}):
+    # split into runs of small files, which are deflated by the pool,
+    # and single large files, which are streamed...
+    runs = []
+    small = []
+    for (absFile, arcname) in members:
+        if os.path.getsize(absFile) > COMPRESS_STREAM_SIZE:
+            if small:
+                runs.append(small)
+                small = []
+            runs.append((absFile, arcname))
+        else:
+            small.append((absFile, arcname, level))
+    if small:
+        runs.append(small)
+
+    pool = None
+    if workers > 1 and len(members) > 1:
+        pool = multiprocessing.Pool(workers)
+    try:
+        for run in runs:
+            if isinstance(run, tuple):
+                streamMember(zip, run[0], run[1], level, modes.get(run[1]))
+                continue
+            if pool:
+                results = pool.imap(deflateMember, run, 16)
+            else:
+                results = map(deflateMember, run)
+            for (arcname, stat, crc, size, data) in results:
+                writeMember(zip, memberInfo(arcname, stat, level, modes.get(arcname)), crc, size, data)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+
+# Returns the mode a file is bundled with. The rules are applied in
+# order, like the chmod calls they stand for: the bits of a matching
+# rule are or-ed in, like chmod a+x would set them, or replace the
+# permission bits, like chmod 755, if the rule has a third, true element
+#  - 0: path: The path of the file below the bundled directory, with /
+#       as separator, "" for the directory itself
+#  - 1: mode: The mode of the file on disk
+#  - 2: modes: List of (pattern, bits) or (pattern, bits, replace)
+#       rules. A pattern is either matched from the start of path or is
+#       a set of the paths it matches
+def bundleMode(path, mode, modes):
+    for rule in modes:
+        if isinstance(rule[0], basestring):
+            matched = re.match(rule[0], path)
+        else:
+            matched = path in rule[0]
+        if matched and len(rule) > 2 and rule[2]:
+            mode = (mode & ~07777) | rule[1]
+        elif matched:
+            mode = mode | rule[1]
+    return mode
+
+
+
+# Lists what tarBundle and zipBundle put in a bundle, in the order tar
+# would add it: a directory, its files and then its subdirectories.
+# Symlinks to directories are listed but not followed. Returns a list
+# of (absPath, arcname, path) tuples, where path is relative to the
+# bundled directory and arcname is name/path.
+#  - 0: rootDir: The directory the bundle is made in
+#  - 1: name: The directory below rootDir to bundle, "." for all
+def bundleEntries(rootDir, name):
+    top = os.path.normpath(os.path.join(rootDir, name))
+    entries = []
+    for (root, dirs, files) in os.walk(top):
+        dirs.sort()
+        path = os.path.relpath(root, top).replace(os.sep, "/")
+        if path == ".":
+            path = ""
+        names = sorted(files) + [dir for dir in dirs if os.path.islink(os.path.join(root, dir))]
+        for entry in [""] + names:
+            entryPath = "/".join([part for part in (path, entry) if part])
+            arcname = "/".join([part for part in (os.path.normpath(name), entryPath) if part and not part == "."])
+            if not arcname:
+                continue
+            entries.append((os.path.join(root, entry), arcname, entryPath))
+    return entries
+
+
+
+# Deflates one member of a GzipBlockWriter, in a worker process.
+# Returns the complete gzip member.
+#  - 0: job: A (data, level) tuple
+def gzipBlock(job):
+    (data, level) = job
+    deflater = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return deflater.compress(data) + deflater.flush()
+
+
+
+# A file object writing a gzip stream made of independent members of
+# GZIP_BLOCK_SIZE bytes, which are deflated in a pool of worker
+# processes, the way pigz does it. Any gzip reader reads the members
+# back as one stream. The file is written sequentially, never seeked.
+class GzipBlockWriter:
+    def __init__(self, file, level, workers):
+        self.file = file
+        self.level = level
+        self.workers = workers
+        self.buffer = []
+        self.buffered = 0
+        self.pending = []
+        self.pool = None
+        if workers > 1:
+            self.pool = multiprocessing.Pool(workers)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered >= GZIP_BLOCK_SIZE:
+            self.deflate()
+
+    # Hands the buffered data to the pool and writes the members that
+    # are done, keeping at most two per worker pending
+    def deflate(self):
+        job = ("".join(self.buffer), self.level)
+        self.buffer = []
+        self.buffered = 0
+        if not self.pool:
+            self.file.write(gzipBlock(job))
+            return
+        self.pending.append(self.pool.apply_async(gzipBlock, (job,)))
+        while len(self.pending) > self.workers * 2:
+            self.file.write(self.pending.pop(0).get())
+
+    # Writes the rest of the stream, the file itself is not closed
+    def close(self):
+        try:
+            if self.buffered > 0:
+                self.deflate()
+            while self.pending:
+                self.file.write(self.pending.pop(0).get())
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+
+
+
+# Bundles a directory into a .tar.gz in one pass, like tar -czf with
+# --owner=0 --group=0. Modes are set in the archive, the files on disk
+# are not touched.
+#  - 0: archive: The name of the .tar.gz to write
+#  - 1: rootDir: The directory the bundle is made in
+#  - 2: name: The directory below rootDir to bundle, "." for all
+#  - 3: modes: Mode rules, see bundleMode
+#  - 4: level: The deflate level
+#  - 5: workers: The number of processes to deflate in, 1 means serial
+def tarBundle(archive, rootDir, name, modes=[], level=COMPRESS_LEVEL, workers=1):
+    file = open(archive, "wb")
+    writer = GzipBlockWriter(file, level, workers)
+    try:
+        tar = tarfile.open(mode="w|", fileobj=writer)
+        for (absPath, arcname, path) in bundleEntries(rootDir, name):
+            info = tar.gettarinfo(absPath, arcname)
+            if info is None:
+                continue
+            info.mode = bundleMode(path, info.mode, modes)
+            info.uid = 0
+            info.gid = 0
+            info.uname = ""
+            info.gname = ""
+            if info.isreg():
+                data = open(absPath, "rb")
+                tar.addfile(info, data)
+                data.close()
+            else:
+                tar.addfile(info)
+        tar.close()
+    finally:
+        writer.close()
+        file.close()
+
+
+
+# Bundles a directory into a .zip in one pass, like zip -r, with the
+# files deflated by compressMembers. Modes are set in the archive, the
+# files on disk are not touched.
+#  - 0: archive: The name of the .zip to write
+#  - 1: rootDir: The directory the bundle is made in
+#  - 2: name: The directory below rootDir to bundle, "." for all
+#  - 3: modes: Mode rules, see bundleMode
+#  - 4: level: The deflate level
+#  - 5: workers: The number of processes to deflate in, 1 means serial
+def zipBundle(archive, rootDir, name, modes=[], level=COMPRESS_LEVEL, workers=1):
+    zip = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+    members = []
+    memberModes = {}
+    for (absPath, arcname, path) in bundleEntries(rootDir, name):
+        if os.path.isdir(absPath):
+            stat = os.stat(absPath)
+            zinfo = memberInfo(arcname + "/", stat, 0, bundleMode(path, stat.st_mode, modes))
+            zinfo.external_attr = zinfo.external_attr | 0x10
+            writeMember(zip, zinfo, 0, 0, "")
+        elif os.path.isfile(absPath):
+            members.append((absPath, arcname))
+            memberModes[arcname] = bundleMode(path, os.stat(absPath).st_mode, modes)
+    compressMembers(zip, members, level, workers, memberModes)
     zip.close()
 
 
 
+# Extracts a single member of an open zipfile below rootDir. The data
+# is copied in blocks of TRANSFER_BLOCK_SIZE so memory use does not
+# depend on the size of the member, and unix permissions stored in the
+# archive are restored.
+#  - 0: zip: The open ZipFile
+#  - 1: info: The ZipInfo of the member
+#  - 2: rootDir: The directory to extract into
+#  - 3: createdDirs: Set of directories known to exist, updated
+def extractMember(zip, info, rootDir, createdDirs):
+    outName = os.path.join(rootDir, info.filename)
+    if info.filename.endswith("/"):
+        parent = os.path.normpath(outName)
+    else:
+        parent = os.path.dirname(outName)
+    if not parent in createdDirs:
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        createdDirs.add(parent)
+    if info.filename.endswith("/"):
+        return
+
+    source = zip.open(info)
+    outfile = open(outName, 'wb')
+    shutil.copyfileobj(source, outfile, TRANSFER_BLOCK_SIZE)
+    outfile.close()
+    source.close()
+
+    mode = (info.external_attr >> 16) & 07777
+    if mode and info.create_system == 3:
+        os.chmod(outName, mode)
+
+
+
+# Extracts a list of members from a zipfile. This is the unit of work
+# handed to the worker processes in uncompress, each opens its own
+# handle on the archive.
+#  - 0: job: A (zipFile, rootDir, names) tuple
+def extractMembers(job):
+    (zipFile, rootDir, names) = job
+    createdDirs = set()
+    file = zipfile.ZipFile(zipFile)
+    for name in names:
+        extractMember(file, file.getinfo(name), rootDir, createdDirs)
+    file.close()
+    return len(names)
+
+
+
 # Decompresses a zipfile to a certain directory
 #  - 0: zipFile: The name of the zipfile to compress
 #  - 1: rootDir: The directory in which to stuff the output..
-def uncompress(zipFile, rootDir):
+#  - 2: workers: The number of processes to extract in, 1 means serial
+def uncompress(zipFile, rootDir, workers=1):
 
     if os.path.isfile(rootDir):
-        raise "   - uncompress: rootdir " + rootDir + " exists and is a file!"
+        raise IOError("uncompress: rootdir " + rootDir + " exists and is a file!")
     elif not os.path.isdir(rootDir):
         os.makedirs(rootDir, 0777)
 
+    createdDirs = set([rootDir])
     file = zipfile.ZipFile(zipFile);
-    for name in file.namelist():
-        absPath = os.path.join(rootDir, "/".join(os.path.split(name)[: -1]))
-        if not os.path.isdir(absPath):
-            os.makedirs(absPath)
-
-        outName = os.path.join(rootDir, name)
-        outfile = open(outName, 'wb')
-        outfile.write(file.read(name))
-        outfile.close()
+    infos = file.infolist()
+    if workers <= 1 or len(infos) < 2:
+        for info in infos:
+            extractMember(file, info, rootDir, createdDirs)
+        file.close()
+        return
 
+    # create the directories up front, then deal the members out to the
+    # workers largest first, each to the worker with the least data...
+    for info in infos:
+        if info.filename.endswith("/"):
+            extractMember(file, info, rootDir, createdDirs)
+        else:
+            parent = os.path.dirname(os.path.join(rootDir, info.filename))
+            if not parent in createdDirs:
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                createdDirs.add(parent)
     file.close()
 
+    members = [info for info in infos if not info.filename.endswith("/")]
+    if len(members) == 0:
+        return
+    members.sort(key=lambda info: info.file_size, reverse=True)
+    bins = [[0, []] for i in range(0, min(workers, len(members)))]
+    for info in members:
+        bin = min(bins, key=lambda bin: bin[0])
+        bin[0] = bin[0] + info.file_size
+        bin[1].append(info.filename)
 
+    pool = multiprocessing.Pool(len(bins))
+    try:
+        pool.map(extractMembers, [(zipFile, rootDir, names) for (size, names) in bins])
+    finally:
+        pool.close()
+        pool.join()
 
-# Opens a connection to hostName and sends the file specified by
-# dataFile to that machine... The port number used is 8184 (ascii dec
-# codes for 'Q', 'T')
-#  - 0: hostName: The host name of the target machine.
+
+
+# Sends the file specified by dataFile over an already connected
+# socket. Uses the operating system's sendfile where available and
+# falls back to sendall with large blocks otherwise, either way the
+# whole file is delivered or an exception is raised. Returns the
+# number of bytes sent.
+#  - 0: socket: The connected socket.
 #  - 1: dataFile: the file to transfer...
-def sendDataFile(socket, dataFile):
+#  - 2: offset: the position in the file to start sending from
+def sendDataFile(socket, dataFile, offset=0):
     file = open(dataFile, "rb")
     debug("   - sendDataFile: transfering %s..." % dataFile)
-    block = file.read(4096)
-    total = len(block)
+    size = os.fstat(file.fileno()).st_size
+    total = offset
+    sendfile = getattr(os, "sendfile", None)
+    if sendfile:
+        try:
+            while total < size:
+                sent = sendfile(socket.fileno(), file.fileno(), total, size - total)
+                if sent == 0:
+                    break
+                total = total + sent
+        except OSError:
+            # not supported for this socket/file, use sendall for the rest
+            pass
+    file.seek(total)
+    block = file.read(TRANSFER_BLOCK_SIZE)
     while len(block) > 0:
-        socket.send(block);
-        block = file.read(4096)
+        socket.sendall(block)
         total = total + len(block)
+        block = file.read(TRANSFER_BLOCK_SIZE)
     file.close()
     debug("   - sendDataFile: transfer of file %s complete, total=%d..." % (dataFile, total))
+    return total - offset
+
+
+
+# Raised when a framed transfer is malformed, truncated or corrupt
+class TransferError(Exception):
+    pass
+
+
+
+# Returns the sha1 hex digest of the content of a file
+#  - 0: fileName: The file to digest
+def fileDigest(fileName):
+    digest = hashlib.sha1()
+    file = open(fileName, "rb")
+    block = file.read(TRANSFER_BLOCK_SIZE)
+    while len(block) > 0:
+        digest.update(block)
+        block = file.read(TRANSFER_BLOCK_SIZE)
+    file.close()
+    return digest.hexdigest()
+
+
+
+# Writes a frame header, a single line of the form
+# "QTJ1 key=value key=value...", to the socket
+#  - 0: socket: The socket
+#  - 1: fields: Dictionary of header fields, values may not contain spaces
+def writeFrameHeader(socket, fields):
+    socket.sendall(formatFrameHeader(fields))
+
+
+
+# Returns the frame header line for a dictionary of fields
+#  - 0: fields: Dictionary of header fields, values may not contain spaces
+def formatFrameHeader(fields):
+    return " ".join([FRAME_MAGIC] + ["%s=%s" % (key, fields[key]) for key in sorted(fields.keys())]) + "\n"
+
+
+
+# Parses a frame header line and returns its fields as a dictionary
+#  - 0: line: The header line
+def parseFrameHeader(line):
+    words = line.split()
+    if len(words) == 0 or words[0] != FRAME_MAGIC:
+        raise TransferError("bad frame header: %s" % line.strip())
+    fields = {}
+    for word in words[1:]:
+        (key, value) = word.split("=", 1)
+        fields[key] = value
+    return fields
+
+
+
+# Reads a single line from the socket byte by byte so that no data
+# following it is consumed.
+#  - 0: socket: The socket
+def readLine(socket):
+    line = ""
+    while not line.endswith("\n"):
+        c = socket.recv(1)
+        if len(c) == 0:
+            raise TransferError("connection closed while reading frame header")
+        line = line + c
+        if len(line) > MAX_FRAME_HEADER:
+            raise TransferError("frame header too long")
+    return line
+
+
+
+# Reads a frame header written by writeFrameHeader and returns its
+# fields as a dictionary.
+#  - 0: socket: The socket
+def readFrameHeader(socket):
+    return parseFrameHeader(readLine(socket))
+
+
+
+# Sends a file as a framed transfer. The header carries the payload
+# size, its sha1 digest and a job id. The receiver answers with the
+# offset it already has for this job and digest, only the remainder
+# is sent, and the receiver finally acknowledges that the digest
+# matched. Returns the number of payload bytes sent.
+#  - 0: socket: The connected socket
+#  - 1: dataFile: the file to transfer...
+#  - 2: jobId: Identifies the transfer, must not contain spaces
+#  - 3: extra: Optional dictionary of additional header fields
+def sendFramed(socket, dataFile, jobId, extra=None):
+    size = os.path.getsize(dataFile)
+    digest = fileDigest(dataFile)
+    fields = { "cmd": "PUT", "job": jobId, "size": size, "digest": digest }
+    if extra:
+        fields.update(extra)
+    writeFrameHeader(socket, fields)
+    offset = int(readFrameHeader(socket)["offset"])
+    if offset > 0:
+        debug("   - sendFramed: resuming %s at offset %d of %d" % (jobId, offset, size))
+    sent = sendDataFile(socket, dataFile, offset)
+    reply = readFrameHeader(socket)
+    if reply.get("status") != "ok":
+        raise TransferError("receiver rejected %s: %s" % (jobId, reply.get("status")))
+    return sent
+
+
+
+# A write-only file object that sends everything written to it as the
+# payload of a streamed framed transfer. The payload is cut into chunks,
+# each preceded by its length in hex on a line of its own, and ends
+# with an empty chunk and a trailer header with the total size and the
+# sha1 digest. tell() is supported, so a ZipFile can be written to it.
+class FrameWriter:
+    def __init__(self, socket):
+        self.socket = socket
+        self.position = 0
+        self.digest = hashlib.sha1()
+        self.pending = []
+        self.pendingSize = 0
+
+    def write(self, data):
+        self.position = self.position + len(data)
+        self.digest.update(data)
+        self.pending.append(data)
+        self.pendingSize = self.pendingSize + len(data)
+        if self.pendingSize >= TRANSFER_BLOCK_SIZE:
+            self.sendChunk()
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def sendChunk(self):
+        data = "".join(self.pending)
+        self.pending = []
+        self.pendingSize = 0
+        self.socket.sendall("%x\n" % len(data))
+        self.socket.sendall(data)
+
+    # Sends what is left, the terminating chunk and the trailer
+    def finish(self):
+        if self.pendingSize > 0:
+            self.sendChunk()
+        self.socket.sendall("0\n")
+        writeFrameHeader(self.socket, { "size": self.position, "digest": self.digest.hexdigest() })
+
+
+
+# Sends a streamed framed transfer whose payload is produced while it
+# is sent, so it never has to be stored first. produce(file) is called
+# with a FrameWriter to write the payload to. Streamed transfers
+# cannot be resumed, the receiver always answers with offset 0, but the
+# same payload can be sent again with sendFramed and the resume field,
+# which continues from what the receiver got of the stream. Returns the
+# number of payload bytes sent.
+#  - 0: socket: The connected socket
+#  - 1: jobId: Identifies the transfer, must not contain spaces
+#  - 2: produce: Function writing the payload to the file it is given
+#  - 3: extra: Optional dictionary of additional header fields
+def sendStreamed(socket, jobId, produce, extra=None):
+    fields = { "cmd": "PUT", "job": jobId, "stream": 1 }
+    if extra:
+        fields.update(extra)
+    writeFrameHeader(socket, fields)
+    readFrameHeader(socket)
+    writer = FrameWriter(socket)
+    produce(writer)
+    writer.finish()
+    reply = readFrameHeader(socket)
+    if reply.get("status") != "ok":
+        raise TransferError("receiver rejected %s: %s" % (jobId, reply.get("status")))
+    return writer.tell()
+
+
+
+# Receives exactly count bytes, or everything until the connection is
+# closed when count is None, from the socket into an open file.
+# Returns the number of bytes received.
+#  - 0: socket: The socket
+#  - 1: file: The file object to write to
+#  - 2: count: The number of bytes to receive
+def receiveInto(socket, file, count=None):
+    buffer = bytearray(TRANSFER_BLOCK_SIZE)
+    view = memoryview(buffer)
+    total = 0
+    while count is None or total < count:
+        wanted = TRANSFER_BLOCK_SIZE
+        if count is not None:
+            wanted = min(wanted, count - total)
+        received = socket.recv_into(buffer, wanted)
+        if received == 0:
+            break
+        file.write(view[:received])
+        total = total + received
+    return total
+
+
+
+# Returns a (partFile, offset) tuple with the name of the partial file
+# for a framed transfer and the number of bytes already received. A
+# transfer with the resume field resends an interrupted stream of the
+# same job, what was received of the stream is where it continues.
+#  - 0: partialDir: The directory to keep partial transfers in
+#  - 1: fields: The frame header of the transfer
+def openPartial(partialDir, fields):
+    jobName = re.sub("[^\\w.-]", "_", fields["job"])
+    if not os.path.isdir(partialDir):
+        os.makedirs(partialDir)
+    streamFile = os.path.join(partialDir, "%s.stream.part" % jobName)
+    if fields.get("stream"):
+        return (streamFile, 0)
+    partFile = os.path.join(partialDir, "%s.%s.part" % (jobName, fields["digest"]))
+    if fields.get("resume") and os.path.isfile(streamFile) and not os.path.isfile(partFile):
+        os.rename(streamFile, partFile)
+    offset = 0
+    if os.path.isfile(partFile):
+        offset = min(os.path.getsize(partFile), int(fields["size"]))
+    return (partFile, offset)
+
+
+
+# Moves a completed partial file to its final name and returns it
+#  - 0: partialDir: The directory to keep partial transfers in
+#  - 1: fields: The frame header of the transfer
+#  - 2: partFile: The partial file from openPartial()
+def finishPartial(partialDir, fields, partFile):
+    jobName = re.sub("[^\\w.-]", "_", fields["job"])
+    dataFile = os.path.join(partialDir, "%s.data" % jobName)
+    if os.path.isfile(dataFile):
+        os.remove(dataFile)
+    os.rename(partFile, dataFile)
+    return dataFile
+
+
+
+# The receiving end of a framed transfer for use in an asyncore loop,
+# sent by sendFramed or sendStreamed. Both plain and streamed transfers
+# are handled. The payload is written to the
+# partial file as it arrives and digested on the fly. Once the transfer
+# is acknowledged handler(fields, dataFile, host) is called from the
+# loop, so it should not block for long. A GET request is answered with
+# the content of the file lookup(fields) returns, or with status
+# missing when there is none.
+#
+# The channel is a small state machine. In the "header", "chunkhead"
+# and "trailer" states it collects a line, in the "payload" and
+# "chunk" states it writes self.remaining bytes to the file, and in
+# the "done" state it only sends what is left of its replies.
+class FrameChannel(asyncore.dispatcher):
+    def __init__(self, sock, host, partialDir, handler, map, lookup=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.host = host
+        self.partialDir = partialDir
+        self.handler = handler
+        self.lookup = lookup
+        self.state = "header"
+        self.line = ""
+        self.fields = None
+        self.file = None
+        self.remaining = 0
+        self.total = 0
+        self.outgoing = ""
+        self.dataFile = None
+        self.buffer = bytearray(TRANSFER_BLOCK_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def readable(self):
+        return self.state != "done"
+
+    def writable(self):
+        return len(self.outgoing) > 0
+
+    def handle_read(self):
+        if self.state in ("payload", "chunk"):
+            received = self.socket.recv_into(self.buffer, min(self.remaining, TRANSFER_BLOCK_SIZE))
+            if received == 0:
+                self.handle_close()
+                return
+            self.consume(self.view[:received])
+        else:
+            data = self.recv(MAX_FRAME_HEADER)
+            if len(data) > 0:
+                self.consume(data)
+
+    # Processes received data according to the current state, a line may
+    # be followed by payload data in the same read.
+    def consume(self, data):
+        while len(data) > 0 and self.state != "done":
+            if self.state in ("payload", "chunk"):
+                count = min(len(data), self.remaining)
+                self.payload(data[:count])
+                data = data[count:]
+                continue
+            self.line = self.line + data
+            end = self.line.find("\n")
+            if end < 0:
+                if len(self.line) > MAX_FRAME_HEADER:
+                    raise TransferError("frame header too long")
+                return
+            data = self.line[end + 1:]
+            line = self.line[:end + 1]
+            self.line = ""
+            self.handleLine(line)
+
+    def handleLine(self, line):
+        if self.state == "header":
+            self.startPayload(parseFrameHeader(line))
+        elif self.state == "chunkhead":
+            self.remaining = int(line, 16)
+            if self.remaining > 0:
+                self.state = "chunk"
+            else:
+                self.state = "trailer"
+        elif self.state == "trailer":
+            trailer = parseFrameHeader(line)
+            if int(trailer["size"]) != self.total:
+                trailer["digest"] = "size-mismatch"
+            self.finishPayload(trailer["digest"])
+
+    def startPayload(self, fields):
+        self.fields = fields
+        if fields.get("cmd") == "GET":
+            self.answerRequest()
+            return
+        (self.partFile, offset) = openPartial(self.partialDir, fields)
+        self.digest = hashlib.sha1()
+        self.outgoing = formatFrameHeader({ "offset": offset })
+        if fields.get("stream"):
+            debug("   - FrameChannel: receiving stream %s" % fields["job"])
+            self.file = open(self.partFile, "wb")
+            self.state = "chunkhead"
+            return
+
+        self.file = open(self.partFile, "ab")
+        self.file.truncate(offset)
+        if offset > 0:
+            existing = open(self.partFile, "rb")
+            block = existing.read(TRANSFER_BLOCK_SIZE)
+            while len(block) > 0:
+                self.digest.update(block)
+                block = existing.read(TRANSFER_BLOCK_SIZE)
+            existing.close()
+        self.remaining = int(fields["size"]) - offset
+        debug("   - FrameChannel: receiving %s, %s bytes from offset %d" % (fields["job"], fields["size"], offset))
+        self.state = "payload"
+        if self.remaining == 0:
+            self.finishPayload(fields["digest"])
+
+    def answerRequest(self):
+        self.state = "done"
+        fileName = None
+        if self.lookup:
+            fileName = self.lookup(self.fields)
+        if fileName is None or not os.path.isfile(fileName):
+            self.outgoing = formatFrameHeader({ "status": "missing" })
+            return
+        file = open(fileName, "rb")
+        data = file.read()
+        file.close()
+        self.outgoing = formatFrameHeader({ "status": "ok", "size": len(data) }) + data
+
+    def payload(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.remaining = self.remaining - len(data)
+        self.total = self.total + len(data)
+        if self.remaining == 0:
+            if self.state == "chunk":
+                self.state = "chunkhead"
+            else:
+                self.finishPayload(self.fields["digest"])
+
+    def finishPayload(self, expectedDigest):
+        self.state = "done"
+        self.file.close()
+        self.file = None
+        if self.digest.hexdigest() != expectedDigest:
+            os.remove(self.partFile)
+            self.outgoing = self.outgoing + formatFrameHeader({ "status": "bad-digest" })
+            debug("   - FrameChannel: digest mismatch for %s" % self.fields["job"])
+            return
+        self.dataFile = finishPartial(self.partialDir, self.fields, self.partFile)
+        self.outgoing = self.outgoing + formatFrameHeader({ "status": "ok" })
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+        if len(self.outgoing) == 0 and self.state == "done":
+            self.close()
+            if self.dataFile:
+                debug("   - FrameChannel: transfer of %s complete" % self.fields["job"])
+                self.handler(self.fields, self.dataFile, self.host)
+
+    def handle_close(self):
+        if self.file:
+            debug("   - FrameChannel: transfer of %s interrupted" % self.fields["job"])
+            self.file.close()
+            self.file = None
+        self.close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.handle_close()
+
+
+
+# Accepts connections on a listening socket and starts a FrameChannel
+# for each of them.
+class FrameListener(asyncore.dispatcher):
+    def __init__(self, sock, partialDir, handler, map, lookup=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        # the socket is already listening, so tell asyncore about it
+        self.accepting = True
+        self.partialDir = partialDir
+        self.handler = handler
+        self.channelMap = map
+        self.lookup = lookup
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted is None:
+            return
+        (sock, (host, port)) = accepted
+        debug("   - FrameListener: connection from %s:%d" % (host, port))
+        FrameChannel(sock, host, self.partialDir, self.handler, self.channelMap, self.lookup)
+
+    def handle_error(self):
+        traceback.print_exc()
+
+
+
+# Receives framed transfers on an already listening socket from one
+# thread, without a thread per connection. handler(fields, dataFile,
+# host) is called for every completed transfer. Runs until done()
+# returns true, or forever when done is None.
+#  - 0: listenSocket: The bound and listening socket
+#  - 1: partialDir: The directory to keep partial transfers in
+#  - 2: handler: Called with each completed transfer
+#  - 3: done: Optional function telling when to stop
+#  - 4: lookup: Optional function returning the file to answer a GET
+#       request with, given its header fields
+def serveFrames(listenSocket, partialDir, handler, done=None, lookup=None):
+    map = {}
+    listener = FrameListener(listenSocket, partialDir, handler, map, lookup)
+    while done is None or not done():
+        asyncore.loop(timeout=1, map=map, count=1)
+    listener.del_channel()
 
 
 
 # Opens a connection to hostName and sends the file specified by
-# dataFile to that machine... The port number used is 8184 (ascii dec
-# codes for 'Q', 'T')
+# dataFile to that machine as a framed transfer. When the connection
+# breaks the transfer is retried, continuing from the offset the
+# receiver already has.
 #  - 0: hostName: The host name of the target machine.
 #  - 1: port: the port of the target machine, preferably PORT_SERVER or PORT_CREATOR
 #  - 2: dataFile: the file to transfer...
-def sendDataFileToHost(hostName, port, dataFile):
+#  - 3: jobId: Identifies the transfer, defaults to the name of the file
+#  - 4: fields: Optional dictionary of additional header fields
+def sendDataFileToHost(hostName, port, dataFile, jobId=None, fields=None):
+    if jobId is None:
+        jobId = os.path.basename(dataFile)
+    address = (hostName, port)
+    attempt = 0
+    while 1:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            debug("   - sendDataFile: connecting to: %s:%d" % address)
+            s.connect(address)
+            sendFramed(s, dataFile, jobId, fields)
+            debug("   - sendDataFile: closed connection...")
+            return
+        except (socket.error, TransferError), e:
+            attempt = attempt + 1
+            if attempt > TRANSFER_RETRIES:
+                raise
+            debug("   - sendDataFile: transfer of %s failed (%s), retry %d in %d seconds..." % (jobId, e, attempt, TRANSFER_RETRY_DELAY))
+            time.sleep(TRANSFER_RETRY_DELAY)
+        finally:
+            s.close()
+
+
+
+# Returns the manifest of a directory tree, a dictionary from the path
+# of each file relative to treeDir, with / as separator, to the sha1
+# digest of its content
+#  - 0: treeDir: The directory to list
+def treeManifest(treeDir):
+    manifest = {}
+    for (absFile, arcname) in listMembers(treeDir):
+        manifest[arcname.replace(os.sep, "/")] = fileDigest(absFile)
+    return manifest
+
+
+
+# Returns a manifest as text, one "digest path" line per file
+def formatManifest(manifest):
+    return "".join(["%s %s\n" % (manifest[name], name) for name in sorted(manifest.keys())])
+
+
+
+# Parses a manifest written by formatManifest
+def parseManifest(data):
+    manifest = {}
+    for line in data.splitlines():
+        if len(line) > 0:
+            (digest, name) = line.split(" ", 1)
+            manifest[name] = digest
+    return manifest
+
+
+
+# Returns a digest identifying the content of a whole manifest
+def manifestDigest(manifest):
+    return hashlib.sha1(formatManifest(manifest)).hexdigest()
+
+
+
+# Writes a manifest to a file, replacing it in one step so readers
+# never see a half written one
+#  - 0: fileName: The file to write
+#  - 1: manifest: The manifest
+def writeManifest(fileName, manifest):
+    tmpFile = fileName + ".tmp"
+    file = open(tmpFile, "wb")
+    file.write(formatManifest(manifest))
+    file.close()
+    if isWindows() and os.path.isfile(fileName):
+        os.remove(fileName)
+    os.rename(tmpFile, fileName)
+
+
+
+# Reads a manifest written by writeManifest, returns an empty manifest
+# when the file does not exist
+def readManifest(fileName):
+    if not os.path.isfile(fileName):
+        return {}
+    file = open(fileName, "rb")
+    manifest = parseManifest(file.read())
+    file.close()
+    return manifest
+
+
+
+# Asks hostName for the manifest of the tree it keeps for jobId.
+# Returns None when the host has no such tree or cannot be asked.
+#  - 0: hostName: The host name of the target machine.
+#  - 1: port: the port of the target machine
+#  - 2: jobId: The tree to get the manifest of
+def fetchManifest(hostName, port, jobId):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect((hostName, port))
+            writeFrameHeader(s, { "cmd": "GET", "job": jobId })
+            reply = readFrameHeader(s)
+            if reply.get("status") != "ok":
+                return None
+            data = cStringIO.StringIO()
+            size = int(reply["size"])
+            if receiveInto(s, data, size) < size:
+                raise TransferError("manifest of %s truncated" % jobId)
+            return parseManifest(data.getvalue())
+        except (socket.error, TransferError), e:
+            debug("   - fetchManifest: no manifest for %s from %s (%s)" % (jobId, hostName, e))
+            return None
+    finally:
+        s.close()
+
+
+
+# Applies an upload made by sendTreeToHost to the tree kept for it:
+# extracts the files it contains over the tree, removes the files listed
+# in its DELTA_MEMBER and updates the manifest to match. Files are
+# unlinked before they are replaced, so treeDir may be made by cloneTree.
+#  - 0: zipFile: The received upload
+#  - 1: treeDir: The tree to update
+#  - 2: manifest: The manifest of treeDir, updated in place
+#  - 3: workers: The number of processes to extract in
+def applyDelta(zipFile, treeDir, manifest, workers=1):
+    zip = zipfile.ZipFile(zipFile)
+    names = zip.namelist()
+    zip.close()
+    for name in names:
+        if os.path.isfile(os.path.join(treeDir, name)):
+            os.remove(os.path.join(treeDir, name))
+    uncompress(zipFile, treeDir, workers)
+    for name in names:
+        if name != DELTA_MEMBER and not name.endswith("/"):
+            manifest[name] = fileDigest(os.path.join(treeDir, name))
+
+    deltaFile = os.path.join(treeDir, DELTA_MEMBER)
+    if os.path.isfile(deltaFile):
+        file = open(deltaFile, "rb")
+        removed = file.read().splitlines()
+        file.close()
+        os.remove(deltaFile)
+        for name in removed:
+            absFile = os.path.join(treeDir, name)
+            if os.path.isfile(absFile):
+                os.remove(absFile)
+            if name in manifest:
+                del manifest[name]
+    return manifest
+
+
+
+# Makes dstFile a reflink of srcFile, a copy sharing its blocks until
+# either is written to. Returns False when the platform or the file
+# system does not support it, dstFile does not exist then.
+#  - 0: srcFile: The file to clone
+#  - 1: dstFile: The file to create
+def reflinkFile(srcFile, dstFile):
+    if fcntl is None:
+        return False
+    src = open(srcFile, "rb")
+    dst = open(dstFile, "wb")
+    try:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            cloned = True
+        except (IOError, OSError):
+            cloned = False
+    finally:
+        src.close()
+        dst.close()
+    if cloned:
+        shutil.copystat(srcFile, dstFile)
+    else:
+        os.remove(dstFile)
+    return cloned
+
+
+
+# Clones the tree srcDir to dstDir as cheaply as the file system
+# allows, in place of shutil.copytree. Files are reflinked where the
+# file system supports it. Otherwise the files macro expansion will not
+# touch are hardlinked, and only the rest is copied. Hardlinked files
+# are shared with srcDir, so they must be replaced rather than written
+# to, see unshareFile. Returns a (reflinked, linked, copied) tuple.
+#  - 0: srcDir: The tree to clone
+#  - 1: dstDir: The directory to create, must not exist
+#  - 2: link: False to copy instead of hardlinking, for trees that are
+#       handed to commands which may write to any of their files
+def cloneTree(srcDir, dstDir, link=True):
+    counts = [0, 0, 0]
+    reflink = fcntl is not None
+    link = link and hasattr(os, "link")
+    for (root, dirs, files) in os.walk(srcDir, followlinks=True):
+        dirs.sort()
+        targetDir = os.path.join(dstDir, os.path.relpath(root, srcDir))
+        os.makedirs(targetDir)
+        shutil.copystat(root, targetDir)
+        for name in sorted(files):
+            srcFile = os.path.join(root, name)
+            dstFile = os.path.join(targetDir, name)
+            if reflink:
+                if reflinkFile(srcFile, dstFile):
+                    counts[0] = counts[0] + 1
+                    continue
+                # no point in asking again for every file...
+                reflink = False
+            if link and not os.path.islink(srcFile) and not EXPAND_PATTERN.search(srcFile):
+                try:
+                    os.link(srcFile, dstFile)
+                    counts[1] = counts[1] + 1
+                    continue
+                except OSError:
+                    # most likely dstDir is on another file system...
+                    link = False
+            shutil.copy2(srcFile, dstFile)
+            counts[2] = counts[2] + 1
+    debug("   - cloneTree: %s -> %s, reflinked=%d, linked=%d, copied=%d" % (srcDir, dstDir, counts[0], counts[1], counts[2]))
+    return tuple(counts)
+
+
+
+# Gives a file that may be hardlinked by cloneTree its own copy, so
+# that it can be written to in place
+#  - 0: fileName: The file
+def unshareFile(fileName):
+    if os.stat(fileName).st_nlink > 1:
+        tmpFile = fileName + ".unshare"
+        shutil.copy2(fileName, tmpFile)
+        os.remove(fileName)
+        os.rename(tmpFile, fileName)
+
+
+
+# Opens a connection to hostName and sends the content of treeDir as a
+# zipfile which is compressed straight into the socket. When the stream
+# breaks, the zipfile is made again in treeDir.spool and sent with
+# sendDataFileToHost, which continues from what the host received of
+# the stream and resumes from the acknowledged offset on further
+# failures. Compression is deterministic, so the spool matches what was
+# streamed, and the host checks the digest of what it got anyway. The
+# spool is removed once the transfer is through.
+#
+# With delta set the host is asked for the manifest of the tree it
+# kept from the previous upload of jobId, and only the files that
+# differ are sent, along with a DELTA_MEMBER listing the removed ones.
+# The upload carries the digest of that manifest in its delta field,
+# or a tree field asking the host to keep the tree when it has none.
+# If the manifest has changed by the time the spool is sent, the
+# delta is made again.
+#  - 0: hostName: The host name of the target machine.
+#  - 1: port: the port of the target machine, preferably PORT_SERVER or PORT_CREATOR
+#  - 2: treeDir: The directory to send
+#  - 3: jobId: Identifies the transfer
+#  - 4: level: The deflate level, 0 stores the files
+#  - 5: workers: The number of processes to deflate in, 1 means serial
+#  - 6: delta: Only send what changed since the last upload of jobId
+#  - 7: fields: Optional dictionary of additional header fields
+def sendTreeToHost(hostName, port, treeDir, jobId, level=COMPRESS_LEVEL, workers=1, delta=False, fields=None):
+    if delta:
+        local = treeManifest(treeDir)
     address = (hostName, port)
-    debug("   - sendDataFile: connecting to: %s:%d" % address)
-    s.connect(address)
-    sendDataFile(s, dataFile)
-    debug("   - sendDataFile: closed connection...")
-    s.close()
+    spoolFile = os.path.normpath(treeDir) + ".spool"
+    attempt = 0
+    while 1:
+        # the host's tree may have changed if a failed attempt got through
+        members = listMembers(treeDir)
+        extra = {}
+        if fields:
+            extra.update(fields)
+        removed = None
+        remote = None
+        if delta:
+            remote = fetchManifest(hostName, port, jobId)
+            if remote is None:
+                extra["tree"] = 1
+            else:
+                extra["delta"] = manifestDigest(remote)
+                members = [(absFile, arcname) for (absFile, arcname) in members
+                           if remote.get(arcname.replace(os.sep, "/")) != local[arcname.replace(os.sep, "/")]]
+                removed = [name for name in sorted(remote.keys()) if not name in local]
+                debug("   - sendTreeToHost: delta of %s, %d of %d files changed, %d removed"
+                      % (jobId, len(members), len(local), len(removed)))
 
+        def produce(file):
+            zip = zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED)
+            compressMembers(zip, members, level, workers)
+            if removed is not None:
+                # a fixed date, a spool made later must match the stream
+                info = zipfile.ZipInfo(DELTA_MEMBER, (1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zip.writestr(info, "".join([name + "\n" for name in removed]))
+            zip.close()
 
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            try:
+                debug("   - sendTreeToHost: connecting to: %s:%d" % address)
+                s.connect(address)
+                total = sendStreamed(s, jobId, produce, extra)
+                debug("   - sendTreeToHost: sent %s, total=%d..." % (treeDir, total))
+                return
+            except (socket.error, TransferError), e:
+                debug("   - sendTreeToHost: streaming %s failed (%s), sending it from a spool..." % (jobId, e))
+        finally:
+            s.close()
 
+        try:
+            if not delta or fetchManifest(hostName, port, jobId) == remote:
+                spool = open(spoolFile, "wb")
+                try:
+                    produce(spool)
+                finally:
+                    spool.close()
+                extra["resume"] = 1
+                sendDataFileToHost(hostName, port, spoolFile, jobId, extra)
+                return
+        finally:
+            if os.path.isfile(spoolFile):
+                os.remove(spoolFile)
 
-# Gets a binary file from the 'socket' and writes it to 'dataFile'
-#  - 0: socket: The socket
-#  - 1: dataFile: the binary file to write..
-def getDataFile(socket, dataFile):
-    debug("   - getDataFile: receiving  %s..." % dataFile)
-    file = open(dataFile, "wb")
-    data = socket.recv(4096)
-    total = len(data)
-    while len(data) > 0:
-        file.write(data);
-        data = socket.recv(4096);
-        total = total + len(data)
-    file.close();
-    debug("   - getDataFile: transfer of file %s complete, total=%d..." % (dataFile, total))
-
-
-# Recursively deletes the directory specified with root
-#  - 0: root: The root directory.
-def rmdirs(root):
-    for (dir, dirs, names) in os.walk(root, False):
+        attempt = attempt + 1
+        if attempt > TRANSFER_RETRIES:
+            raise TransferError("the tree kept for %s keeps changing" % jobId)
+        debug("   - sendTreeToHost: the tree kept for %s changed, making the delta again..." % jobId)
+
+
+
+# Removes the files of a list, the unit of work of removeTree
+def removeFileList(files):
+    for file in files:
+        os.remove(file)
+
+
+
+# Deletes a directory tree like shutil.rmtree, but unlinks the files
+# from a pool of threads, which keeps several unlinks in flight on file
+# systems where each of them waits for the disk or the network.
+# Directories are removed afterwards, deepest first. Symbolic links
+# are removed, never followed.
+#  - 0: root: The directory to delete
+#  - 1: workers: The number of threads to delete files in
+def removeTree(root, workers=DELETE_WORKERS):
+    if os.path.islink(root):
+        os.remove(root)
+        return
+    dirs = []
+    files = []
+    for (dir, subdirs, names) in os.walk(root):
+        dirs.append(dir)
+        for name in subdirs[:]:
+            if os.path.islink(os.path.join(dir, name)):
+                files.append(os.path.join(dir, name))
+                subdirs.remove(name)
         for name in names:
-            os.remove(os.path.join(dir, name))
+            files.append(os.path.join(dir, name))
+
+    if workers > 1 and len(files) > DELETE_CHUNK_SIZE:
+        pool = WorkerPool(workers, workers * 2)
+        for i in range(0, len(files), DELETE_CHUNK_SIZE):
+            pool.submit(removeFileList, files[i:i + DELETE_CHUNK_SIZE])
+        pool.close()
+    else:
+        removeFileList(files)
+
+    # a file that failed to go makes its directory fail here too...
+    for dir in reversed(dirs):
         os.rmdir(dir)
 
 
 
+discardCount = 0
+discardLock = threading.Lock()
+
+# Gets a directory tree out of the way at once and deletes it in the
+# background. The tree is renamed next to where it is, which is cheap,
+# and removed by removeTree in a thread of its own. The threads are not
+# daemons, so the process does not exit before the trees are gone. If
+# the tree cannot be renamed it is deleted before returning.
+#  - 0: root: The directory to discard
+def discardTree(root):
+    global discardCount
+    if not os.path.lexists(root):
+        return
+    discardLock.acquire()
+    discardCount = discardCount + 1
+    discarded = "%s.discard-%d-%d" % (os.path.normpath(root), os.getpid(), discardCount)
+    discardLock.release()
+    try:
+        os.rename(root, discarded)
+    except OSError:
+        removeTree(root)
+        return
+    thread = threading.Thread(target=removeTree, args=(discarded,))
+    thread.start()
+
+
+
+# A fixed number of threads working off a queue of jobs. With maxPending
+# set the queue is bounded and submit() blocks while it is full, so a
+# fast producer cannot run ahead of the workers. By default it is not,
+# and submit() never blocks. Exceptions raised by a job are printed and
+# otherwise ignored. The workers run until close() is called.
+class WorkerPool:
+    def __init__(self, workers, maxPending=0):
+        self.queue = Queue.Queue(maxPending)
+        self.threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while 1:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            (function, args) = job
+            try:
+                function(*args)
+            except:
+                traceback.print_exc()
+            self.queue.task_done()
+
+    # Queues function(*args) to be run by one of the workers
+    def submit(self, function, *args):
+        self.queue.put((function, args))
+
+    # Waits until all submitted jobs have completed
+    def join(self):
+        self.queue.join()
+
+    # Waits until all submitted jobs have completed and stops the
+    # workers. No jobs may be submitted afterwards.
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+
+# Task states, see TaskGraph
+TASK_WAITING = "waiting"
+TASK_RUNNING = "running"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+TASK_SKIPPED = "skipped"
+
+# A node in a TaskGraph, created by TaskGraph.add()
+class Task:
+    def __init__(self, name, function, args, depends, after, resources):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.depends = depends
+        self.after = after
+        self.resources = resources
+        self.state = TASK_WAITING
+
+    def finished(self):
+        return self.state in (TASK_DONE, TASK_FAILED, TASK_SKIPPED)
+
+
+
+# Runs a graph of tasks, each in a thread of its own, as soon as the
+# tasks it depends on are done and the resources it uses are free. A
+# resource is a name with a limit on the number of tasks using it at
+# the same time, such as "cpu", "network" or one per build host.
+# Resources without a limit are not limited. Tasks that are ready at
+# the same time are started in the order they were added. A task that
+# raises is failed and the tasks depending on it are skipped.
+class TaskGraph:
+    def __init__(self, limits={}):
+        self.limits = dict(limits)
+        self.used = {}
+        self.tasks = []
+        self.condition = threading.Condition()
+
+    # Sets the number of tasks that may use resource at the same time
+    def setLimit(self, resource, limit):
+        self.limits[resource] = limit
+
+    # Adds a task running function(*args) and returns it
+    #  - 0: name: The name of the task, for logging
+    #  - 1: function: The function to run
+    #  - 2: args: The arguments to the function
+    #  - 3: depends: Tasks which must be done before this one can run
+    #  - 4: after: Tasks which must have finished, successfully or not
+    #  - 5: resources: The names of the resources the task uses
+    def add(self, name, function, args=(), depends=[], after=[], resources=[]):
+        task = Task(name, function, args, list(depends), list(after), list(resources))
+        self.tasks.append(task)
+        return task
+
+    def available(self, task):
+        for resource in task.resources:
+            if resource in self.limits and self.used.get(resource, 0) >= self.limits[resource]:
+                return False
+        return True
+
+    def run(self, task):
+        try:
+            task.function(*task.args)
+            state = TASK_DONE
+        except:
+            traceback.print_exc()
+            state = TASK_FAILED
+        self.condition.acquire()
+        for resource in task.resources:
+            self.used[resource] = self.used[resource] - 1
+        task.state = state
+        debug(" - task %s %s" % (task.name, state))
+        self.condition.notifyAll()
+        self.condition.release()
+
+    # Runs all the tasks and waits for them to finish. Returns the
+    # tasks that failed or were skipped.
+    def execute(self):
+        self.condition.acquire()
+        while 1:
+            running = 0
+            for task in self.tasks:
+                if task.state == TASK_RUNNING:
+                    running = running + 1
+                if not task.state == TASK_WAITING:
+                    continue
+                if [dep for dep in task.depends if dep.state in (TASK_FAILED, TASK_SKIPPED)]:
+                    task.state = TASK_SKIPPED
+                    debug(" - task %s skipped" % task.name)
+                    continue
+                if [dep for dep in task.depends if not dep.state == TASK_DONE]:
+                    continue
+                if [dep for dep in task.after if not dep.finished()]:
+                    continue
+                if not self.available(task):
+                    continue
+                for resource in task.resources:
+                    self.used[resource] = self.used.get(resource, 0) + 1
+                task.state = TASK_RUNNING
+                running = running + 1
+                debug(" - task %s started" % task.name)
+                thread = threading.Thread(target=self.run, args=(task,))
+                thread.setDaemon(True)
+                thread.start()
+            if running == 0:
+                break
+            # with a timeout, so that Ctrl-C gets through on python 2...
+            self.condition.wait(1)
+        self.condition.release()
+        return [task for task in self.tasks if not task.state == TASK_DONE]
+
+
+
 # Returns true if the script is running on mac os x
 def isMac():
     return platform.system().find("Darwin") >= 0;
@@ -177,48 +1783,248 @@ def readLicenseHeader(license, startDir):
 
 
 
+# The macroes expanded by expandMacroes, minus the year which is
+# computed when the expansion runs. The values None are replaced by
+# the license header.
+MACROES = {
+    "TROLLTECH": "Nokia",
+    "PRODUCT": "Qt Jambi",
+    "LICENSE": None,
+    "TROLLTECH_DUAL_LICENSE": None,
+    "CPP_LICENSE": None,
+    "JAVA_LICENSE": None
+    }
+
+# A single alternation of all the macroes, so that a file is scanned
+# only once regardless of how many macroes there are...
+MACRO_PATTERN = re.compile("\\$(THISYEAR|%s)\\$" % "|".join(MACROES.keys()))
+
+# The files that are candidates for macro expansion
+EXPAND_PATTERN = re.compile("\\.cpp$|\\.h$|\\.java|\\.html|\\.ui|LICENSE")
+
+
+
+# Returns the name -> replacement table used to expand macroes
+#  - 0: header: The content to replace $LICENSE$ tags
+def macroTable(header):
+    table = { "THISYEAR": "%d" % datetime.date.today().year }
+    for (name, value) in MACROES.items():
+        if value is None:
+            value = header
+        table[name] = value
+    return table
+
+
+
+# Returns a digest identifying the output of a macro table, used as
+# part of the key in the ExpansionCache.
+#  - 0: table: The name -> replacement table from macroTable()
+def tableDigest(table):
+    digest = hashlib.sha1()
+    for name in sorted(table.keys()):
+        digest.update("%s=%d:%s\n" % (name, len(table[name]), table[name]))
+    return digest.hexdigest()
+
+
+
+# An on-disk cache of expanded files, keyed by the digest of the
+# unexpanded source and the digest of the macro table. Each entry is
+# stored as root/xx/key together with a key.hits file holding the
+# number of expanded macroes. Entries are touched when used so that
+# evict() can drop the least recently used ones once the cache grows
+# beyond maxSize bytes.
+#
+# With link set, cached entries are hardlinked into the target tree
+# rather than copied, so the tree must not be modified in place
+# afterwards, see --expand-cache-link. The cache must be on the same
+# file system as the tree then.
+class ExpansionCache:
+    def __init__(self, root, maxSize, link=False):
+        self.root = root
+        self.maxSize = maxSize
+        self.link = link
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def entryName(self, sourceDigest, headerDigest):
+        key = sourceDigest + headerDigest
+        return os.path.join(self.root, key[:2], key)
+
+    # Replaces file with the cached entry, returns the number of
+    # macroes expanded in the entry or None if there is no entry. The
+    # entry is put next to file and renamed over it, file is left as it
+    # is if the entry goes away in the meantime.
+    def fetch(self, entry, file):
+        try:
+            handle = open(entry + ".hits", "r")
+            hits = int(handle.read())
+            handle.close()
+            if hits and self.link:
+                os.link(entry, file + ".cached")
+            elif hits:
+                shutil.copyfile(entry, file + ".cached")
+                os.chmod(file + ".cached", 0755)
+            if hits:
+                # replace rather than rewrite, the file may be linked by cloneTree
+                os.rename(file + ".cached", file)
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            if os.path.isfile(file + ".cached"):
+                os.remove(file + ".cached")
+            return None
+        return hits
+
+    def store(self, entry, content, hits):
+        dir = os.path.dirname(entry)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # another worker may have created it already...
+                pass
+        # unique names, several threads or processes may store the
+        # same entry at once. The entry and its hits are both renamed
+        # into place, so a fetch never sees them half written, and the
+        # hits go last, a fetch that finds them finds the entry too...
+        tmpNames = []
+        try:
+            for (data, mode) in ((content, 0755), ("%d" % hits, 0644)):
+                (fd, tmpName) = tempfile.mkstemp(".tmp", os.path.basename(entry) + ".", dir)
+                tmpNames.append(tmpName)
+                handle = os.fdopen(fd, "w")
+                handle.write(data)
+                handle.close()
+                os.chmod(tmpName, mode)
+            os.rename(tmpNames[0], entry)
+            os.rename(tmpNames[1], entry + ".hits")
+        except (IOError, OSError):
+            for tmpName in tmpNames:
+                if os.path.isfile(tmpName):
+                    os.remove(tmpName)
+
+    # Removes the least recently used entries until the cache is below
+    # maxSize bytes. Returns the number of entries evicted.
+    def evict(self):
+        entries = []
+        total = 0
+        for (root, dirs, files) in os.walk(self.root):
+            for name in files:
+                if name.endswith(".hits") or name.endswith(".tmp"):
+                    continue
+                entry = os.path.join(root, name)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    # evicted by another process meanwhile...
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+                total = total + stat.st_size
+        entries.sort()
+        evicted = 0
+        for (mtime, size, entry) in entries:
+            if total <= self.maxSize:
+                break
+            # the hits go first, a fetch that finds them finds the entry too
+            for name in (entry + ".hits", entry):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            total = total - size
+            evicted = evicted + 1
+        return evicted
+
+
+
+# Expands the macroes in a single file. Files without macroes are left
+# untouched. Returns a (hits, reused) tuple with the number of macroes
+# that were replaced and whether the result came from the cache.
+#  - 0: file: The file to expand
+#  - 1: table: The name -> replacement table from macroTable()
+#  - 2: cache: An optional ExpansionCache
+#  - 3: headerDigest: The tableDigest() of table, needed with a cache
+def expandFile(file, table, cache=None, headerDigest=None):
+    handle = open(file, "r")
+    content = handle.read()
+    handle.close()
+    if content.find("$") < 0:
+        return (0, False)
+    if cache:
+        entry = cache.entryName(hashlib.sha1(content).hexdigest(), headerDigest)
+        hits = cache.fetch(entry, file)
+        if hits is not None:
+            return (hits, True)
+    (content, hits) = MACRO_PATTERN.subn(lambda match: table[match.group(1)], content)
+    if hits:
+        # replace rather than rewrite, the file may be linked by cloneTree
+        os.remove(file)
+        handle = open(file, "w")
+        handle.write(content)
+        handle.close()
+        os.chmod(file, 0755)
+    if cache:
+        cache.store(entry, content, hits)
+    return (hits, False)
+
+
+
+# Expands the macroes in a list of files. This is the unit of work
+# handed to the worker processes in expandMacroes. Returns a list of
+# (file, hits, reused) tuples in the same order as the input.
+#  - 0: job: A (files, table, cache) tuple
+def expandFileChunk(job):
+    (files, table, cache) = job
+    headerDigest = None
+    if cache:
+        headerDigest = tableDigest(table)
+    result = []
+    for file in files:
+        (hits, reused) = expandFile(file, table, cache, headerDigest)
+        result.append((file, hits, reused))
+    return result
+
+
+
 # Locates all text files and expands the $LICENSE$ macroes and similar
-# located in them
+# located in them. Returns a dictionary of file -> number of macroes
+# replaced for each file that was changed.
 # 0: dir: The directory to perform the expansion
 # 1: header: The content to replace $LICENSE$ tags
-def expandMacroes(dir, header):
-    thisYear = "%d" % datetime.date.today().year
-    patterns = [
-        [ re.compile("\\$THISYEAR\\$"), thisYear ],
-        [ re.compile("\\$TROLLTECH\\$"), "Nokia" ],
-        [ re.compile("\\$PRODUCT\\$"), "Qt Jambi" ],
-        [ re.compile("\\$LICENSE\\$"), header ],
-        [ re.compile("\\$TROLLTECH_DUAL_LICENSE\\$"), header ],
-        [ re.compile("\\$CPP_LICENSE\\$"), header ],
-        [ re.compile("\\$JAVA_LICENSE\\$"), header ]
-        ]
-    
-    extensions = [
-        re.compile("\\.cpp$"),
-        re.compile("\\.h$"),
-        re.compile("\\.java"),
-        re.compile("\\.html"),
-        re.compile("\\.ui"),
-        re.compile("LICENSE")
-        ]
+# 2: workers: The number of processes to expand in, 1 means serial
+# 3: cache: An optional ExpansionCache to reuse earlier expansions from
+def expandMacroes(dir, header, workers=1, cache=None):
+    table = macroTable(header)
+    candidates = []
     for (root, dirs, files) in os.walk(dir):
-        for relfile in files:
+        dirs.sort()
+        for relfile in sorted(files):
             file = os.path.join(root, relfile)
-            replace = False
-            for ext in extensions:
-                if ext.search(file):
-                    replace = True
-            if replace:
-                handle = open(file, "r")
-                content = handle.read()
-                handle.close()
-                check = False
-                for (regex, replacement) in patterns:
-                    content = re.sub(regex, replacement, content)
-                os.chmod(file, 0755)
-                handle = open(file, "w")
-                handle.write(content)
-                handle.close()
-
+            if EXPAND_PATTERN.search(file):
+                candidates.append(file)
 
+    if workers > 1 and len(candidates) > EXPAND_CHUNK_SIZE:
+        jobs = [(candidates[i:i + EXPAND_CHUNK_SIZE], table, cache)
+                for i in range(0, len(candidates), EXPAND_CHUNK_SIZE)]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = []
+            for chunk in pool.imap(expandFileChunk, jobs):
+                results.extend(chunk)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = expandFileChunk((candidates, table, cache))
 
+    stats = {}
+    reused = 0
+    for (file, hits, fromCache) in results:
+        if hits:
+            stats[file] = hits
+        if fromCache:
+            reused = reused + 1
+    debug("   - expandMacroes: %d macroes in %d files under %s" % (sum(stats.values()), len(stats), dir))
+    if cache:
+        evicted = cache.evict()
+        debug("   - expandMacroes: reused %d of %d files from cache, evicted %d entries" % (reused, len(candidates), evicted))
+    return stats
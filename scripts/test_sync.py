@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+# Tests the --incremental-sync mode of package_builder against the
+# p4stub.py stand-in:
+#
+#   python scripts/test_sync.py
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import package_builder
+import pkgutil
+
+QTJAMBI_DEPOT = "qtjambi/4.5.0"
+
+class IncrementalSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.depotDir = os.path.join(self.dir, "depot")
+        self.stateDir = os.path.join(self.dir, "p4state")
+        os.makedirs(self.stateDir)
+        self.writeDepot("build.xml", "<project/>")
+        self.writeDepot("src/a.java", "class A {}")
+        self.writeDepot("src/b.java", "class B {}")
+        self.writeDepot("src/c.java", "class C {}")
+
+        self.saved = package_builder.options
+        options = package_builder.Options()
+        options.qtJambiVersion = "4.5.0"
+        options.qtVersion = "4.5"
+        options.packageRoot = os.path.join(self.dir, "root")
+        options.artifactRoot = os.path.join(self.dir, "artifacts")
+        stub = os.path.join(os.path.dirname(os.path.abspath(__file__)), "p4stub.py")
+        options.p4Command = "%s %s %s %s" % (sys.executable, stub, self.depotDir, self.stateDir)
+        options.incrementalSync = True
+        package_builder.options = options
+        pkgutil.VERBOSE = 0
+
+    def tearDown(self):
+        package_builder.options = self.saved
+        # wait for the trees discarded in the background...
+        for thread in threading.enumerate():
+            if thread is not threading.currentThread() and not thread.isDaemon():
+                thread.join()
+        shutil.rmtree(self.dir)
+
+    def writeDepot(self, name, content):
+        fileName = os.path.join(self.depotDir, QTJAMBI_DEPOT, name)
+        if not os.path.isdir(os.path.dirname(fileName)):
+            os.makedirs(os.path.dirname(fileName))
+        file = open(fileName, "w")
+        file.write(content)
+        file.close()
+
+    def localFile(self, name):
+        return os.path.join(package_builder.options.packageRoot, "qtjambi", name)
+
+    def read(self, name):
+        file = open(self.localFile(name))
+        content = file.read()
+        file.close()
+        return content
+
+    def writes(self):
+        logName = os.path.join(self.stateDir, "writes.log")
+        if not os.path.isfile(logName):
+            return []
+        writes = [os.path.relpath(line.strip(), self.localFile("")) for line in open(logName)]
+        os.remove(logName)
+        return sorted(writes)
+
+    def testUnchangedFilesAreNotRewritten(self):
+        package_builder.prepareSourceTree()
+        self.assertEqual(self.writes(), ["build.xml", "src/a.java", "src/b.java", "src/c.java"])
+        stat = os.stat(self.localFile("src/b.java"))
+
+        time.sleep(1.1)
+        package_builder.prepareSourceTree()
+        self.assertEqual(self.writes(), [])
+        self.assertEqual(os.stat(self.localFile("src/b.java")).st_mtime, stat.st_mtime)
+        self.assertEqual(os.stat(self.localFile("src/b.java")).st_ino, stat.st_ino)
+
+    def testChangedFilesAreSynced(self):
+        package_builder.prepareSourceTree()
+        self.writes()
+
+        # the previous run left the workspace writable, the changed
+        # revision must still replace the file...
+        self.assertTrue(os.access(self.localFile("src/a.java"), os.W_OK))
+        self.writeDepot("src/a.java", "class A { int changed; }")
+        self.writeDepot("src/d.java", "class D {}")
+        os.remove(os.path.join(self.depotDir, QTJAMBI_DEPOT, "src/c.java"))
+
+        package_builder.prepareSourceTree()
+        self.assertEqual(self.writes(), ["src/a.java", "src/d.java"])
+        self.assertEqual(self.read("src/a.java"), "class A { int changed; }")
+        self.assertFalse(os.path.exists(self.localFile("src/c.java")))
+
+    def testLocalChangesAreReverted(self):
+        package_builder.prepareSourceTree()
+        self.writes()
+
+        file = open(self.localFile("src/a.java"), "w")
+        file.write("edited")
+        file.close()
+        os.remove(self.localFile("src/b.java"))
+        os.makedirs(self.localFile("stale/dir"))
+        open(self.localFile("stale/dir/x.o"), "w").close()
+        open(self.localFile("src/y.class"), "w").close()
+        os.makedirs(os.path.join(package_builder.options.artifactRoot, "qtjambi-src-lgpl-4.5.0"))
+
+        package_builder.prepareSourceTree()
+        self.assertEqual(self.writes(), ["src/a.java", "src/b.java"])
+        self.assertEqual(self.read("src/a.java"), "class A {}")
+        self.assertEqual(self.read("src/b.java"), "class B {}")
+        self.assertFalse(os.path.exists(self.localFile("stale")))
+        self.assertFalse(os.path.exists(self.localFile("src/y.class")))
+        self.assertEqual(os.listdir(package_builder.options.artifactRoot), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Checks that the zipfiles pkgutil writes through pkgutil.writeRawMember,
+# which uses the internals of the zipfile module, read back with
+# zipfile and pkgutil.uncompress:
+#
+#   python scripts/test_zip.py
+
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import pkgutil
+
+# A file object that cannot seek, like the FrameWriter uploads are
+# written to
+class SequentialFile:
+    def __init__(self, fileName):
+        self.file = open(fileName, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ZipWriteTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.treeDir = os.path.join(self.dir, "tree")
+        self.write("small.txt", "small file\n" * 100)
+        self.write("empty.txt", "")
+        self.write("sub/binary.dat", os.urandom(100000))
+        self.write("sub/large.dat", "large file\n" * 50000 + os.urandom(200000))
+        self.savedStreamSize = pkgutil.COMPRESS_STREAM_SIZE
+        # small enough for large.dat to be streamed...
+        pkgutil.COMPRESS_STREAM_SIZE = 300000
+        pkgutil.VERBOSE = 0
+
+    def tearDown(self):
+        pkgutil.COMPRESS_STREAM_SIZE = self.savedStreamSize
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        fileName = os.path.join(self.treeDir, name)
+        if not os.path.isdir(os.path.dirname(fileName)):
+            os.makedirs(os.path.dirname(fileName))
+        file = open(fileName, "wb")
+        file.write(content)
+        file.close()
+
+    def read(self, fileName):
+        file = open(fileName, "rb")
+        content = file.read()
+        file.close()
+        return content
+
+    def compress(self, level, workers):
+        zipName = os.path.join(self.dir, "tree-%d-%d.zip" % (level, workers))
+        file = SequentialFile(zipName)
+        zip = zipfile.ZipFile(file, "w", zipfile.ZIP_DEFLATED)
+        pkgutil.compressMembers(zip, pkgutil.listMembers(self.treeDir), level, workers)
+        zip.close()
+        file.close()
+        return zipName
+
+    def assertRoundTrip(self, zipName):
+        zip = zipfile.ZipFile(zipName)
+        self.assertEqual(zip.testzip(), None)
+        zip.close()
+        outDir = os.path.join(self.dir, "out")
+        pkgutil.uncompress(zipName, outDir)
+        for (absFile, arcname) in pkgutil.listMembers(self.treeDir):
+            self.assertEqual(self.read(os.path.join(outDir, arcname)), self.read(absFile))
+        self.assertEqual(len(pkgutil.listMembers(outDir)), len(pkgutil.listMembers(self.treeDir)))
+        shutil.rmtree(outDir)
+
+    def testDeflated(self):
+        self.assertRoundTrip(self.compress(pkgutil.COMPRESS_LEVEL, 1))
+
+    def testDeflatedInWorkers(self):
+        self.assertRoundTrip(self.compress(pkgutil.COMPRESS_LEVEL, 2))
+
+    def testStored(self):
+        self.assertRoundTrip(self.compress(0, 1))
+
+    def testBundle(self):
+        zipName = os.path.join(self.dir, "bundle.zip")
+        pkgutil.zipBundle(zipName, self.dir, "tree", [ ("sub/", 0111) ], pkgutil.COMPRESS_LEVEL, 2)
+        zip = zipfile.ZipFile(zipName)
+        self.assertEqual(zip.testzip(), None)
+        self.assertTrue(zip.getinfo("tree/sub/").external_attr & 0x10)
+        self.assertEqual((zip.getinfo("tree/sub/large.dat").external_attr >> 16) & 0111, 0111)
+        self.assertEqual((zip.getinfo("tree/small.txt").external_attr >> 16) & 0111, 0)
+        zip.close()
+
+if __name__ == "__main__":
+    unittest.main()